@@ -0,0 +1,98 @@
+'''
+Story <-> detection <-> baseline <-> response task relationships of the security-content repo,
+built in one pass over the manifests and shared by generate.py and doc-gen.py.
+'''
+
+from spl import parse_search
+
+
+# story aggregates collected from the tags of its detections
+AGGREGATE_TAGS = {
+    'mitre_attack': 'mitre_attack_id',
+    'kill_chain_phases': 'kill_chain_phases',
+    'cis20': 'cis20',
+    'nist': 'nist',
+}
+
+STORY_KEYS = ['detections', 'baselines', 'response_tasks', 'data_models'] + list(AGGREGATE_TAGS)
+
+
+def as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def analytics_stories(object):
+    if 'tags' in object and 'analytics_story' in object['tags']:
+        return as_list(object['tags']['analytics_story'])
+    return []
+
+
+class ContentGraph(object):
+    '''
+    For every story: the names of its detections, baselines and response tasks, and the data models,
+    MITRE ATT&CK ids, kill chain phases, CIS and NIST controls of its detections. All lists are sorted.
+    Every story manifest gets a node, even before anything refers to it.
+    '''
+
+    def __init__(self, stories, detections, baselines=None, response_tasks=None):
+        self.stories = {}
+        self.story_names = set(story['name'] for story in stories)
+        for story_name in sorted(self.story_names):
+            self._story(story_name)
+
+        for detection in detections:
+            data_model = parse_search(detection['search']).data_model()
+            for story_name in analytics_stories(detection):
+                story = self._story(story_name)
+                story['detections'].add(detection['name'])
+                if data_model:
+                    story['data_models'].add(data_model)
+                for key, tag in AGGREGATE_TAGS.items():
+                    if tag in detection['tags']:
+                        story[key].update(as_list(detection['tags'][tag]))
+
+        for baseline in baselines or []:
+            for story_name in analytics_stories(baseline):
+                self._story(story_name)['baselines'].add(baseline['name'])
+
+        for response_task in response_tasks or []:
+            for story_name in analytics_stories(response_task):
+                self._story(story_name)['response_tasks'].add(response_task['name'])
+
+        for story in self.stories.values():
+            for key in story:
+                story[key] = sorted(story[key])
+
+    def _story(self, story_name):
+        if story_name not in self.stories:
+            self.stories[story_name] = dict((key, set()) for key in STORY_KEYS)
+        return self.stories[story_name]
+
+    def story(self, story_name):
+        '''Aggregates of a story, empty lists for a story nothing refers to.'''
+        if story_name in self.stories:
+            return self.stories[story_name]
+        return dict((key, []) for key in STORY_KEYS)
+
+    def detections(self, story_name):
+        return self.story(story_name)['detections']
+
+    def baselines(self, story_name):
+        return self.story(story_name)['baselines']
+
+    def response_tasks(self, story_name):
+        return self.story(story_name)['response_tasks']
+
+    def unknown_stories(self):
+        '''Story names the analytics_story tags refer to without a story manifest, with the names of the objects tagged.'''
+        unknown = {}
+        for story_name, story in self.stories.items():
+            if story_name not in self.story_names:
+                unknown[story_name] = story['detections'] + story['baselines'] + story['response_tasks']
+        return unknown
+
+    def mappings(self, story_name):
+        story = self.story(story_name)
+        return dict((key, story[key]) for key in AGGREGATE_TAGS if story[key])
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Checks the homoglyph permutations of package/bin/dnstwist.py against the window and str.replace
+implementation they replaced, and times both. dnstwist.py imports splunklib and the splunk module,
+so run it with the python of a Splunk install:
+
+    splunk cmd python bin/dnstwist-benchmark.py -p .
+'''
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import random
+import sys
+import time
+from os import path
+
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789-.'
+
+# repeated letters, runs at either end, sub-domains and punycode
+EDGE_CASES = ['splunk.com', 'google.com', 'www.splunk.com', 'mississippi.com', 'a.com', 'aa.com', 'aba.com', 'aaaa.io',
+              'xn--80ak6aa92e.com', 'microsoft.co.uk', 'dddd-dd.d.de', 'wwwwww.com', 'microsoftonline-corporate.com']
+
+
+def reference_homoglyph(domain, glyphs):
+    '''The homoglyphs of a domain as the original dnstwist made them, duplicates included.'''
+    for ws in range(0, len(domain)):
+        for i in range(0, (len(domain)-ws)+1):
+            win = domain[i:i+ws]
+
+            j = 0
+            while j < ws:
+                c = win[j]
+                if c in glyphs:
+                    win_copy = win
+                    for g in glyphs[c]:
+                        win = win.replace(c, g)
+                        yield domain[:i] + win + domain[i+ws:]
+                        win = win_copy
+                j += 1
+
+
+def benchmark_domains(count, seed):
+    random.seed(seed)
+    domains = list(EDGE_CASES)
+    domains += [''.join(random.choice(ALPHABET) for _ in range(random.randint(1, 30))) + '.com' for _ in range(count)]
+    # few distinct letters with many glyphs give long runs
+    domains += [''.join(random.choice('abmlo') for _ in range(random.randint(1, 20))) + '.com' for _ in range(count)]
+    return domains
+
+
+def compare_homoglyphs(REPO_PATH, count, seed, verbose):
+    sys.path.insert(0, path.join(path.expanduser(REPO_PATH), 'package', 'bin'))
+    try:
+        from dnstwist import DomainFuzz, GLYPHS
+    except ImportError as exc:
+        sys.exit("ERROR: can't import dnstwist ({0}), run with splunk cmd python".format(exc))
+
+    reference_time = homoglyph_time = 0.0
+    generated = unique = mismatches = 0
+
+    for position, domain in enumerate(benchmark_domains(count, seed)):
+        edge_case = position < len(EDGE_CASES)
+        fuzzer = DomainFuzz(domain)
+
+        start = time.time()
+        reference = list(reference_homoglyph(fuzzer.domain, GLYPHS))
+        reference_seconds = time.time() - start
+
+        start = time.time()
+        homoglyphs = list(fuzzer._DomainFuzz__homoglyph())
+        homoglyph_seconds = time.time() - start
+
+        reference_time += reference_seconds
+        homoglyph_time += homoglyph_seconds
+        generated += len(reference)
+        unique += len(set(reference))
+
+        if set(reference) != set(homoglyphs):
+            mismatches += 1
+            print("MISMATCH: {0} has {1} homoglyphs only the original makes and {2} only the new one makes".format(
+                domain, len(set(reference) - set(homoglyphs)), len(set(homoglyphs) - set(reference))))
+        elif verbose and edge_case:
+            print("{0}: {1} homoglyphs, {2:.3f}s -> {3:.3f}s".format(domain, len(homoglyphs), reference_seconds, homoglyph_seconds))
+
+        # deeper substitutions only add to the single character ones
+        if edge_case and not set(reference) <= set(DomainFuzz(domain, homoglyph_depth=2)._DomainFuzz__homoglyph()):
+            mismatches += 1
+            print("MISMATCH: homoglyph_depth=2 drops homoglyphs of {0}".format(domain))
+
+    print("{0} domains, {1} unique homoglyphs out of {2} generated by the original".format(
+        len(EDGE_CASES) + 2 * count, unique, generated))
+    print("original {0:.2f}s, per position {1:.2f}s".format(reference_time, homoglyph_time))
+
+    if mismatches:
+        sys.exit("ERROR: {0} domains differ".format(mismatches))
+    print("homoglyphs match the original for every domain")
+
+
+if __name__ == "__main__":
+
+    # grab arguments
+    parser = argparse.ArgumentParser(description="compares the dnstwist homoglyph permutations with the original implementation")
+    parser.add_argument("-p", "--path", required=True, help="path to security-content repo")
+    parser.add_argument("-n", "--domains", required=False, default=3000, type=int, help="random domains of each kind to compare, 3000 by default")
+    parser.add_argument("--seed", required=False, default=1, type=int, help="seed of the random domains")
+    parser.add_argument("-v", "--verbose", required=False, default=False, action='store_true', help="print the timings of every edge case")
+
+    # parse them
+    args = parser.parse_args()
+    compare_homoglyphs(args.path, args.domains, args.seed, args.verbose)
@@ -3,98 +3,49 @@ import yaml
 import argparse
 from os import path
 import sys
-import re
 from jinja2 import Environment, FileSystemLoader
+from manifest_cache import ManifestCache, default_cache_file
+from content_graph import ContentGraph
 
 
-def load_objects(file_path):
+def load_objects(file_path, cache=None):
     files = []
     manifest_files = path.join(path.expanduser(REPO_PATH), file_path)
 
     for file in sorted(glob.glob(manifest_files)):
-        files.append(load_file(file))
+        files.append(load_file(file, cache))
 
     return files
 
 
-def load_file(file_path):
-    with open(file_path, 'r') as stream:
-        try:
+def load_file(file_path, cache=None):
+    try:
+        if cache is not None:
+            return cache.load(file_path)
+        with open(file_path, 'r') as stream:
             file = list(yaml.safe_load_all(stream))[0]
-        except yaml.YAMLError as exc:
-            print(exc)
-            sys.exit("ERROR: reading {0}".format(file_path))
+    except yaml.YAMLError as exc:
+        print(exc)
+        sys.exit("ERROR: reading {0}".format(file_path))
     return file
 
 
-def prepare_content(stories, detections):
+def prepare_content(stories, graph):
 
     # enrich stories with information from detections: data_models, mitre_ids, kill_chain_phases, nists
-    sto_to_data_models = {}
-    sto_to_mitre_attack_ids = {}
-    sto_to_kill_chain_phases = {}
-    sto_to_ciss = {}
-    sto_to_nists = {}
-    sto_to_det = {}
-    for detection in detections:
-        if 'analytics_story' in detection['tags']:
-            for story in detection['tags']['analytics_story']:
-                if story in sto_to_det.keys():
-                    sto_to_det[story].add(detection['name'])
-                else:
-                    sto_to_det[story] = {detection['name']}
-
-                data_model = parse_data_models_from_search(detection['search'])
-                if data_model:
-                    if story in sto_to_data_models.keys():
-                        sto_to_data_models[story].add(data_model)
-                    else:
-                        sto_to_data_models[story] = {data_model}
-
-                if 'mitre_attack_id' in detection['tags']:
-                    if story in sto_to_mitre_attack_ids.keys():
-                        for mitre_attack_id in detection['tags']['mitre_attack_id']:
-                            sto_to_mitre_attack_ids[story].add(mitre_attack_id)
-                    else:
-                        for mitre_attack_id in detection['tags']['mitre_attack_id']:
-                            sto_to_mitre_attack_ids[story] = {mitre_attack_id}
-
-                if 'kill_chain_phases' in detection['tags']:
-                    if story in sto_to_kill_chain_phases.keys():
-                        for kill_chain in detection['tags']['kill_chain_phases']:
-                            sto_to_kill_chain_phases[story].add(kill_chain)
-                    else:
-                        for kill_chain in detection['tags']['kill_chain_phases']:
-                            sto_to_kill_chain_phases[story] = {kill_chain}
-
-                if 'cis20' in detection['tags']:
-                    if story in sto_to_ciss.keys():
-                        for cis in detection['tags']['cis20']:
-                            sto_to_ciss[story].add(cis)
-                    else:
-                        for cis in detection['tags']['cis20']:
-                            sto_to_ciss[story] = {cis}
-
-                if 'nist' in detection['tags']:
-                    if story in sto_to_nists.keys():
-                        for nist in detection['tags']['nist']:
-                            sto_to_nists[story].add(nist)
-                    else:
-                        for nist in detection['tags']['nist']:
-                            sto_to_nists[story] = {nist}
-
     for story in stories:
-        story['detections'] = sorted(sto_to_det[story['name']])
-        if story['name'] in sto_to_data_models:
-            story['data_models'] = sorted(sto_to_data_models[story['name']])
-        if story['name'] in sto_to_mitre_attack_ids:
-            story['mitre_attack_ids'] = sorted(sto_to_mitre_attack_ids[story['name']])
-        if story['name'] in sto_to_kill_chain_phases:
-            story['kill_chain_phases'] = sorted(sto_to_kill_chain_phases[story['name']])
-        if story['name'] in sto_to_ciss:
-            story['ciss'] = sorted(sto_to_ciss[story['name']])
-        if story['name'] in sto_to_nists:
-            story['nists'] = sorted(sto_to_nists[story['name']])
+        aggregates = graph.story(story['name'])
+        story['detections'] = aggregates['detections']
+        if aggregates['data_models']:
+            story['data_models'] = aggregates['data_models']
+        if aggregates['mitre_attack']:
+            story['mitre_attack_ids'] = aggregates['mitre_attack']
+        if aggregates['kill_chain_phases']:
+            story['kill_chain_phases'] = aggregates['kill_chain_phases']
+        if aggregates['cis20']:
+            story['ciss'] = aggregates['cis20']
+        if aggregates['nist']:
+            story['nists'] = aggregates['nist']
 
     #sort stories into categories
     categories = []
@@ -117,9 +68,9 @@ def prepare_content(stories, detections):
     return categories
 
 
-def write_splunk_docs(stories, detections, OUTPUT_DIR):
+def write_splunk_docs(stories, graph, OUTPUT_DIR):
 
-    categories = prepare_content(stories, detections)
+    categories = prepare_content(stories, graph)
 
     j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
                          trim_blocks=True)
@@ -132,9 +83,9 @@ def write_splunk_docs(stories, detections, OUTPUT_DIR):
     return len(stories), output_path
 
 
-def write_markdown_docs(stories, detections, OUTPUT_DIR):
+def write_markdown_docs(stories, graph, OUTPUT_DIR):
 
-    categories = prepare_content(stories, detections)
+    categories = prepare_content(stories, graph)
 
     j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
                          trim_blocks=True)
@@ -656,12 +607,6 @@ def write_markdown_docs_bak(stories, detections, OUTPUT_DIR):
     return story_count, paths
 
 
-def parse_data_models_from_search(search):
-    match = re.search('from\sdatamodel\s?=\s?([^\s.]*)',search)
-    if match is not None:
-        return match.group(1)
-    return False
-
 if __name__ == "__main__":
 
     # grab arguments
@@ -674,6 +619,8 @@ if __name__ == "__main__":
                         help="generates wiki markup splunk documentation, default to true")
     parser.add_argument("-gmd", "--gen_markdown_docs", required=False, default=True, action='store_true',
                         help="generates markdown docs, default to true")
+    parser.add_argument("--cache_file", required=False, default=None, help="path to the parsed manifest cache, defaults to <path>/.cache/manifests.pickle")
+    parser.add_argument("--no_cache", required=False, default=False, action='store_true', help="parse every manifest from scratch and do not touch the cache")
 
     # parse them
     args = parser.parse_args()
@@ -683,20 +630,25 @@ if __name__ == "__main__":
     gsd = args.gen_splunk_docs
     gmd = args.gen_markdown_docs
 
-    stories = load_objects("stories/*.yml")
-    detections = load_objects("detections/*.yml")
+    cache = None if args.no_cache else ManifestCache(args.cache_file or default_cache_file(REPO_PATH))
+    stories = load_objects("stories/*.yml", cache)
+    detections = load_objects("detections/*.yml", cache)
+    if cache is not None:
+        cache.save()
+
+    graph = ContentGraph(stories, detections)
 
     # complete_stories = generate_stories(REPO_PATH, verbose)
     # complete_detections = generate_detections(REPO_PATH, complete_stories)
 
     if gsd:
-        story_count, path = write_splunk_docs(stories, detections, OUTPUT_DIR)
+        story_count, path = write_splunk_docs(stories, graph, OUTPUT_DIR)
         print("{0} story documents have been successfully written to {1}".format(story_count, path))
     else:
         print("--gen_splunk_docs  was set to false, not generating splunk documentation")
 
     if gmd:
-        story_count, path = write_markdown_docs(stories, detections,  OUTPUT_DIR)
+        story_count, path = write_markdown_docs(stories, graph, OUTPUT_DIR)
         print("{0} story documents have been successfully written to {1}".format(story_count, path)) 
     else:
         print("--gen_splunk_docs  was set to false, not generating splunk documentation")
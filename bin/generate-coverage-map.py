@@ -10,6 +10,7 @@ import csv
 from os import path
 from stix2 import FileSystemSource
 from stix2 import Filter
+from manifest_cache import ManifestCache, default_cache_file
 
 VERSION = "3.0"
 NAME = "Detection Coverage"
@@ -22,13 +23,18 @@ def main(argv):
     parser = argparse.ArgumentParser(description='Detection Coverage')
     parser.add_argument('--projects_path', default='.', action='store', metavar='N', help='folder containing the projects Mitre Cyber Threat Intelligence Repository, Security Content and Sigma')
     parser.add_argument('--output', default='output', action='store', help='result output directory, defaults to output')
+    parser.add_argument('--cache_file', default=None, action='store', help='path to the parsed manifest cache, defaults to <projects_path>/.cache/manifests.pickle')
+    parser.add_argument('--no_cache', default=False, action='store_true', help='parse every manifest from scratch and do not touch the cache')
     cmdargs = parser.parse_args()
 
     print("get all techniques")
     techniques = get_all_techniques(cmdargs.projects_path)
 
     print("count techniques")
-    detections = load_objects(path.join(cmdargs.projects_path),'detections/*.yml')
+    cache = None if cmdargs.no_cache else ManifestCache(cmdargs.cache_file or default_cache_file(cmdargs.projects_path))
+    detections = load_objects(path.join(cmdargs.projects_path),'detections/*.yml', cache)
+    if cache is not None:
+        cache.save()
 
     print("get matched techniques")
     matched_techniques = get_matched_techniques(techniques, detections)
@@ -181,26 +187,28 @@ def generate_csv_file(matched_techniques, output):
 #    print("Recommended detections were successfully written to output/detections.csv")
 
 
-def load_objects(security_content_path, file_path):
+def load_objects(security_content_path, file_path, cache=None):
     files = []
     detection_files = path.join(path.expanduser(security_content_path), file_path)
 
     for file in glob.glob(detection_files):
         files.append({
             "filename": os.path.basename(file),
-            "object": load_file(file)
+            "object": load_file(file, cache)
         })
 
     return files
 
 
-def load_file(file_path):
-    with open(file_path, 'r') as stream:
-        try:
+def load_file(file_path, cache=None):
+    try:
+        if cache is not None:
+            return cache.load(file_path)
+        with open(file_path, 'r') as stream:
             file = list(yaml.safe_load_all(stream))[0]
-        except yaml.YAMLError as exc:
-#            print(exc)
-            sys.exit("ERROR: reading {0}".format(file_path))
+    except yaml.YAMLError as exc:
+#        print(exc)
+        sys.exit("ERROR: reading {0}".format(file_path))
     return file
 
 if __name__ == "__main__":
@@ -10,24 +10,76 @@ import argparse
 from os import path
 import sys
 import datetime
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import re
 from attackcti import attack_client
 import csv
+import json
+import hashlib
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from manifest_cache import ManifestCache, MISS, default_cache_file
+from incremental_build import BuildState, splice_conf, default_state_file, sources_digest
+from content_graph import ContentGraph, AGGREGATE_TAGS
+from spl import parse_search
+from macro_expansion import filter_macros as generate_filter_macros
+from schedule_analysis import schedule_report, spread_schedules
 
 
 # global variables
 REPO_PATH = ''
 VERBOSE = False
 OUTPUT_PATH = ''
+JOBS = 1
+CACHE = None
+BUILD_STATE = None
+CHANGES = None
+MITRE_CACHE_FILE = '.cache/mitre_enrichment.pickle'
+PANELS_MANIFEST_FILE = '.cache/workbench_panels.json'
+
+# modules rendering the confs, an incremental build starts over when one of them or a template changes
+GENERATOR_SOURCES = ['generate.py', 'incremental_build.py', 'content_graph.py', 'spl.py', 'macro_expansion.py', 'schedule_analysis.py']
+
+# one environment shared by all writers: templates are compiled once per run and their bytecode
+# is kept in the per-user jinja2 cache directory, so compilation happens once per machine
+J2_ENV = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
+                     trim_blocks=True,
+                     auto_reload=False,
+                     bytecode_cache=FileSystemBytecodeCache())
+
+def manifest_paths(file_path):
+    manifest_files = path.join(path.expanduser(REPO_PATH), file_path)
+    return sorted(glob.glob(manifest_files))
+
 
-def load_objects(file_path, VERBOSE):
+def load_objects(file_path, VERBOSE, executor=None):
     files = []
-    manifest_files = path.join(path.expanduser(REPO_PATH), file_path)
-    for file in sorted(glob.glob(manifest_files)):
+    manifest_files = manifest_paths(file_path)
+
+    # serve unchanged manifests from the cache, remember the positions that still need parsing
+    missing = []
+    for file in manifest_files:
         if VERBOSE:
             print("processing manifest: {0}".format(file))
-        files.append(load_file(file))
+        object = CACHE.get(file) if CACHE is not None else MISS
+        if object is MISS:
+            missing.append(len(files))
+        files.append(object)
+
+    # fan the parsing out over the process pool, map keeps the sorted order
+    missing_files = [manifest_files[i] for i in missing]
+    if executor is not None and len(missing_files) > 1:
+        chunksize = max(1, len(missing_files) // (JOBS * 4))
+        parsed = executor.map(load_file, missing_files, chunksize=chunksize)
+    else:
+        parsed = map(load_file, missing_files)
+
+    for i, object in zip(missing, parsed):
+        files[i] = object
+        if CACHE is not None:
+            CACHE.put(manifest_files[i], object)
+
     return files
 
 
@@ -41,47 +93,62 @@ def load_file(file_path):
     return file
 
 
-def generate_transforms_conf(lookups):
-    sorted_lookups = sorted(lookups, key=lambda i: i['name'])
+def write_incremental(template, conf, output_path, ascii_only=False, **partial_context):
+    '''
+    Renders only the stanzas of the changed objects and splices them into the existing conf.
+    Returns False when the conf has to be rendered in full.
+    '''
+    if BUILD_STATE is None or not BUILD_STATE.can_splice(CHANGES, conf, output_path):
+        return False
 
-    utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+    output = template.render(**partial_context)
+    if ascii_only:
+        output = output.encode('ascii', 'ignore').decode('ascii')
+    if not splice_conf(output_path, output):
+        return False
+
+    if VERBOSE:
+        print("spliced {0} changed objects into {1}".format(len(CHANGES), output_path))
+    BUILD_STATE.record_output(conf, output_path)
+    return True
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('transforms.j2')
-    output_path = OUTPUT_PATH + "/default/transforms.conf"
-    output = template.render(lookups=sorted_lookups, time=utc_time)
-    with open(output_path, 'w') as f:
-        f.write(output)
+
+def write_file(output_path, chunks):
+    # write into a temp file renamed over the output so nobody ever reads a half written file
+    tmp_path = '{0}.{1}.tmp'.format(output_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
     return output_path
 
-def generate_collections_conf(lookups):
-    filtered_lookups = list(filter(lambda i: 'collection' in i, lookups))
-    sorted_lookups = sorted(filtered_lookups, key=lambda i: i['name'])
 
-    utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+def write_template(template, output_path, ascii_only=False, **context):
+    # stream the rendered chunks straight to disk so the whole output is never held in memory
+    chunks = template.generate(**context)
+    if ascii_only:
+        chunks = (chunk.encode('ascii', 'ignore').decode('ascii') for chunk in chunks)
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('collections.j2')
-    output_path = OUTPUT_PATH + "/default/collections.conf"
-    output = template.render(lookups=sorted_lookups, time=utc_time)
-    with open(output_path, 'w') as f:
-        f.write(output)
+    return write_file(output_path, chunks)
 
-    return output_path
 
+def enrich_searches(detections, response_tasks, baselines, deployments):
 
-def generate_savedsearches_conf(detections, response_tasks, baselines, deployments):
+    deployment_index = index_deployments(deployments)
 
     for detection in detections:
         # parse out data_models
-        data_model = parse_data_models_from_search(detection['search'])
+        data_model = parse_search(detection['search']).data_model()
         if data_model:
             detection['data_model'] = data_model
 
-        matched_deployments = get_deployments(detection, deployments)
+        matched_deployments = get_deployments(detection, deployment_index)
         if len(matched_deployments):
             detection['deployment'] = matched_deployments[-1]
             nes_fields = get_nes_fields(detection['search'], detection['deployment'])
@@ -100,191 +167,273 @@ def generate_savedsearches_conf(detections, response_tasks, baselines, deploymen
         detection['mappings'] = mappings
 
     for baseline in baselines:
-        data_model = parse_data_models_from_search(baseline['search'])
+        data_model = parse_search(baseline['search']).data_model()
         if data_model:
             baseline['data_model'] = data_model
 
-        matched_deployments = get_deployments(baseline, deployments)
+        matched_deployments = get_deployments(baseline, deployment_index)
         if len(matched_deployments):
             baseline['deployment'] = matched_deployments[-1]
 
     for response_task in response_tasks:
         if 'search' in response_task:
-            data_model = parse_data_models_from_search(response_task['search'])
+            data_model = parse_search(response_task['search']).data_model()
             if data_model:
                 response_task['data_model'] = data_model
 
+
+def enrich_stories(stories, graph):
+
+    stories = prepare_stories(stories, graph)
+
+    for story in stories:
+        story['author_name'], story['author_company'] = parse_author_company(story)
+        if graph.baselines(story['name']):
+            story['baselines'] = ['ESCU - ' + name for name in graph.baselines(story['name'])]
+        if graph.response_tasks(story['name']):
+            story['response_tasks'] = ['ESCU - ' + name for name in graph.response_tasks(story['name'])]
+            story['searches'] = story['detections'] + story['response_tasks']
+        else:
+            story['searches'] = story['detections']
+
+        if graph.response_tasks(story['name']):
+            response_task_names = graph.response_tasks(story['name'])
+            story['workbench_panels'] = []
+            for response_task_name in response_task_names:
+                str = 'panel://workbench_panel_' + response_task_name.replace(' ', '_').replace('-','_').replace('.','_').replace('/','_').lower()
+                story['workbench_panels'].append(str)
+            story['lowercase_name'] = story['name'].replace(' ', '_').replace('-','_').replace('.','_').replace('/','_').lower()
+
+    return stories
+
+
+def enrich_workbench_panels(response_tasks):
+    workbench_panel_objects = []
+    for response_task in response_tasks:
+        if 'search' in response_task:
+            if 'inputs' in response_task:
+                response_file_name = response_task['name'].replace(' ', '_').replace('-','_').replace('.','_').replace('/','_').lower()
+                response_task['lowercase_name'] = response_file_name
+                workbench_panel_objects.append(response_task)
+
+    return workbench_panel_objects
+
+
+def generate_transforms_conf(lookups):
+    sorted_lookups = sorted(lookups, key=lambda i: i['name'])
+
     utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    j2_env.filters['custom_jinja2_enrichment_filter'] = custom_jinja2_enrichment_filter
-    template = j2_env.get_template('savedsearches.j2')
-    output_path = OUTPUT_PATH + "/default/savedsearches.conf"
-    output = template.render(detections=detections, baselines=baselines, response_tasks=response_tasks, time=utc_time)
-    with open(output_path, 'w') as f:
-        output = output.encode('ascii', 'ignore').decode('ascii')
-        f.write(output)
+    template = J2_ENV.get_template('transforms.j2')
+    output_path = OUTPUT_PATH + "/default/transforms.conf"
+    write_template(template, output_path, lookups=sorted_lookups, time=utc_time)
 
     return output_path
 
+def generate_collections_conf(lookups):
+    filtered_lookups = list(filter(lambda i: 'collection' in i, lookups))
+    sorted_lookups = sorted(filtered_lookups, key=lambda i: i['name'])
 
-def generate_analytics_story_conf(stories, detections, response_tasks, baselines):
-
-    sto_det = map_detection_to_stories(detections)
+    utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
 
-    sto_res = map_response_tasks_to_stories(response_tasks)
+    template = J2_ENV.get_template('collections.j2')
+    output_path = OUTPUT_PATH + "/default/collections.conf"
+    write_template(template, output_path, lookups=sorted_lookups, time=utc_time)
 
-    sto_bas = map_baselines_to_stories(baselines)
+    return output_path
 
-    for story in stories:
-        if story['name'] in sto_det:
-            story['detections'] = list(sto_det[story['name']])
-        if story['name'] in sto_res:
-            story['response_tasks'] = list(sto_res[story['name']])
-        if story['name'] in sto_bas:
-            story['baselines'] = list(sto_bas[story['name']])
 
-    stories = prepare_stories(stories, detections)
+def generate_savedsearches_conf(detections, response_tasks, baselines):
 
     utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('analytic_stories.j2')
-    output_path = OUTPUT_PATH + "/default/analytic_stories.conf"
-    output = template.render(stories=stories, time=utc_time)
-    with open(output_path, 'w') as f:
-        f.write(output)
+    template = J2_ENV.get_template('savedsearches.j2')
+    output_path = OUTPUT_PATH + "/default/savedsearches.conf"
+    if CHANGES is not None and write_incremental(template, 'savedsearches.conf', output_path, ascii_only=True,
+                                                 detections=CHANGES.select('detections', detections),
+                                                 baselines=CHANGES.select('baselines', baselines),
+                                                 response_tasks=CHANGES.select('response_tasks', response_tasks),
+                                                 time=utc_time):
+        return output_path
+
+    write_template(template, output_path, ascii_only=True,
+                   detections=detections, baselines=baselines, response_tasks=response_tasks, time=utc_time)
+
+    if BUILD_STATE is not None:
+        BUILD_STATE.record_output('savedsearches.conf', output_path)
 
     return output_path
 
 
-def generate_use_case_library_conf(stories, detections, response_tasks, baselines):
+def generate_analytics_story_conf(stories):
 
-    sto_det = map_detection_to_stories(detections)
+    utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
 
-    sto_res = map_response_tasks_to_stories(response_tasks)
+    template = J2_ENV.get_template('analytic_stories.j2')
+    output_path = OUTPUT_PATH + "/default/analytic_stories.conf"
+    if CHANGES is not None and write_incremental(template, 'analytic_stories.conf', output_path,
+                                                 stories=CHANGES.select('stories', stories), time=utc_time):
+        return output_path
 
-    for story in stories:
-        story['author_name'], story['author_company'] = parse_author_company(story)
-        if story['name'] in sto_det:
-            story['detections'] = list(sto_det[story['name']])
-        if story['name'] in sto_res:
-            story['response_tasks'] = list(sto_res[story['name']])
-            story['searches'] = story['detections'] + story['response_tasks']
-        else:
-            story['searches'] = story['detections']
+    write_template(template, output_path, stories=stories, time=utc_time)
 
-    for detection in detections:
+    if BUILD_STATE is not None:
+        BUILD_STATE.record_output('analytic_stories.conf', output_path)
 
-        keys = ['mitre_attack', 'kill_chain_phases', 'cis20', 'nist']
-        mappings = {}
-        for key in keys:
-            if key == 'mitre_attack':
-                if 'mitre_attack_id' in detection['tags']:
-                    mappings[key] = detection['tags']['mitre_attack_id']
-            else:
-                if key in detection['tags']:
-                    mappings[key] = detection['tags'][key]
-        detection['mappings'] = mappings
+    return output_path
+
+
+def generate_use_case_library_conf(stories, detections, response_tasks, baselines):
 
     utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('use_case_library.j2')
+    template = J2_ENV.get_template('use_case_library.j2')
     output_path = OUTPUT_PATH + "/default/use_case_library.conf"
-    output = template.render(stories=stories, detections=detections,
-                             response_tasks=response_tasks,
-                             baselines=baselines, time=utc_time)
-    with open(output_path, 'w') as f:
-        f.write(output)
+    if CHANGES is not None and write_incremental(template, 'use_case_library.conf', output_path,
+                                                 stories=CHANGES.select('stories', stories),
+                                                 detections=CHANGES.select('detections', detections),
+                                                 response_tasks=CHANGES.select('response_tasks', response_tasks),
+                                                 baselines=CHANGES.select('baselines', baselines),
+                                                 time=utc_time):
+        return output_path
+
+    write_template(template, output_path, stories=stories, detections=detections,
+                   response_tasks=response_tasks,
+                   baselines=baselines, time=utc_time)
+
+    if BUILD_STATE is not None:
+        BUILD_STATE.record_output('use_case_library.conf', output_path)
 
     return output_path
 
 
 def generate_macros_conf(macros, detections):
-    filter_macros = []
-    for detection in detections:
-        new_dict = {}
-        new_dict['definition'] = 'search *'
-        new_dict['description'] = 'Update this macro to limit the output results to filter out false positives. '
-        new_dict['name'] = detection['name']. \
-            replace(' ', '_').replace('-', '_').replace('.', '_').replace('/', '_').lower() + '_filter'
-        filter_macros.append(new_dict)
+    filter_macros = generate_filter_macros(detections)
 
     all_macros = macros + filter_macros
 
     utc_time = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('macros.j2')
+    template = J2_ENV.get_template('macros.j2')
     output_path = OUTPUT_PATH + "/default/macros.conf"
-    output = template.render(macros=all_macros, time=utc_time)
-    with open(output_path, 'w') as f:
-        f.write(output)
+    if CHANGES is not None:
+        # a detection only owns its filter macro
+        changed_detections = set(d['name'] for d in CHANGES.select('detections', detections))
+        changed_filter_macros = [m for m, d in zip(filter_macros, detections) if d['name'] in changed_detections]
+        if write_incremental(template, 'macros.conf', output_path,
+                             macros=CHANGES.select('macros', macros) + changed_filter_macros, time=utc_time):
+            return output_path
+
+    write_template(template, output_path, macros=all_macros, time=utc_time)
+
+    if BUILD_STATE is not None:
+        BUILD_STATE.record_output('macros.conf', output_path)
 
     return output_path
 
 
-def generate_workbench_panels(response_tasks, stories):
+def load_panels_manifest(panels_path):
+    manifest_file = path.join(path.expanduser(REPO_PATH), PANELS_MANIFEST_FILE)
+    if path.isfile(manifest_file):
+        try:
+            with open(manifest_file, 'r') as f:
+                return json.load(f).get(path.abspath(panels_path), {})
+        except ValueError:
+            pass
+    return {}
 
-    sto_res = map_response_tasks_to_stories(response_tasks)
 
-    for story in stories:
-        if story['name'] in sto_res:
-            response_task_names = list(sto_res[story['name']])
-            story['workbench_panels'] = []
-            for response_task_name in response_task_names:
-                str = 'panel://workbench_panel_' + response_task_name[7:].replace(' ', '_').replace('-','_').replace('.','_').replace('/','_').lower()
-                story['workbench_panels'].append(str)
-            story['lowercase_name'] = story['name'].replace(' ', '_').replace('-','_').replace('.','_').replace('/','_').lower()
+def save_panels_manifest(panels_path, panels):
+    manifest_file = path.join(path.expanduser(REPO_PATH), PANELS_MANIFEST_FILE)
+    manifest = {}
+    if path.isfile(manifest_file):
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            manifest = {}
+    manifest[path.abspath(panels_path)] = panels
 
-    workbench_panel_objects = []
-    for response_task in response_tasks:
-        if 'search' in response_task:
-            if 'inputs' in response_task:
-                response_file_name = response_task['name'].replace(' ', '_').replace('-','_').replace('.','_').replace('/','_').lower()
-                response_task['lowercase_name'] = response_file_name
-                workbench_panel_objects.append(response_task)
-                j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                                     trim_blocks=True)
-                template = j2_env.get_template('panel.j2')
-                output_path = OUTPUT_PATH + "/default/data/ui/panels/workbench_panel_" + response_file_name + ".xml"
-                
-                if response_task['search'].find(">") is not -1:
-                    response_task['search']= response_task['search'].replace(">","&gt;")
-                if response_task['search'].find("<") is not -1:
-                    response_task['search']= response_task['search'].replace("<","&lt;")
-
-                output = template.render(search=response_task['search'])
-                with open(output_path, 'w') as f:
-                    f.write(output)
-
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('es_investigations.j2')
+    if not path.isdir(path.dirname(manifest_file)):
+        os.makedirs(path.dirname(manifest_file))
+    write_file(manifest_file, [json.dumps(manifest, indent=2, sort_keys=True)])
+
+
+def generate_workbench_panels(workbench_panel_objects):
+
+    panels_path = OUTPUT_PATH + "/default/data/ui/panels"
+    previous_panels = load_panels_manifest(panels_path)
+    panels = {}
+    written = 0
+
+    # render every panel from the one compiled template, only files whose content hash changed
+    # (or that were touched outside of the generator) are rewritten
+    template = J2_ENV.get_template('panel.j2')
+    for response_task in workbench_panel_objects:
+        file_name = "workbench_panel_" + response_task['lowercase_name'] + ".xml"
+        output_path = path.join(panels_path, file_name)
+
+        # escape the search for the panel xml only, savedsearches.conf keeps the original
+        search = response_task['search'].replace(">","&gt;").replace("<","&lt;")
+
+        output = template.render(search=search)
+        digest = hashlib.sha256(output.encode('utf-8')).hexdigest()
+
+        previous = previous_panels.get(file_name)
+        if previous is None or previous['digest'] != digest or not path.isfile(output_path) \
+                or previous['stat'] != list(panel_stat(output_path)):
+            write_file(output_path, [output])
+            written += 1
+
+        panels[file_name] = {'digest': digest, 'stat': list(panel_stat(output_path))}
+
+    # prune the panels of response tasks that are gone
+    for panel_file in glob.glob(path.join(panels_path, "workbench_panel_*.xml")):
+        if path.basename(panel_file) not in panels:
+            if VERBOSE:
+                print("removing stale workbench panel {0}".format(panel_file))
+            os.remove(panel_file)
+
+    save_panels_manifest(panels_path, panels)
+
+    if VERBOSE:
+        print("{0} of {1} workbench panels have been rewritten in {2}".format(written, len(panels), panels_path))
+
+    return panels_path
+
+
+def panel_stat(panel_file):
+    st = os.stat(panel_file)
+    return st.st_mtime_ns, st.st_size
+
+
+def generate_es_investigations_conf(workbench_panel_objects, stories):
+
+    template = J2_ENV.get_template('es_investigations.j2')
     output_path = OUTPUT_PATH + "/default/es_investigations.conf"
-    output = template.render(response_tasks=workbench_panel_objects, stories=stories)
-    with open(output_path, 'w') as f:
-        f.write(output)
+    write_template(template, output_path, response_tasks=workbench_panel_objects, stories=stories)
+
+    return output_path
+
+
+def generate_workflow_actions_conf(workbench_panel_objects):
 
-    j2_env = Environment(loader=FileSystemLoader('bin/jinja2_templates'),
-                         trim_blocks=True)
-    template = j2_env.get_template('workflow_actions.j2')
+    template = J2_ENV.get_template('workflow_actions.j2')
     output_path = OUTPUT_PATH + "/default/workflow_actions.conf"
-    output = template.render(response_tasks=workbench_panel_objects)
-    with open(output_path, 'w') as f:
-        f.write(output)
+    write_template(template, output_path, response_tasks=workbench_panel_objects)
 
+    return output_path
+
+
+def run_writers(writers):
+    # the writers only read the enriched objects and each owns its output files, so they can run
+    # side by side; results come back in the order the writers were listed
+    if JOBS == 1:
+        return [writer(*writer_args) for writer, writer_args in writers]
 
-def parse_data_models_from_search(search):
-    match = re.search(r'from\sdatamodel\s?=\s?([^\s.]*)', search)
-    if match is not None:
-        return match.group(1)
-    return False
+    with ThreadPoolExecutor(max_workers=JOBS) as executor:
+        futures = [executor.submit(writer, *writer_args) for writer, writer_args in writers]
+        return [future.result() for future in futures]
 
 
 def parse_author_company(story):
@@ -303,88 +452,61 @@ def parse_author_company(story):
     return match_author, match_company
 
 
-def get_deployments(object, deployments):
-    matched_deployments = []
+def tag_values(value):
+    if type(value) is list:
+        return value
+    return [value]
 
-    for deployment in deployments:
+
+def tag_index_key(tag, value):
+    # tag values are plain strings in practice, anything unhashable is keyed by its json form
+    try:
+        hash(value)
+    except TypeError:
+        value = json.dumps(value, sort_keys=True, default=str)
+    return tag, value
+
+
+def index_deployments(deployments):
+    # inverted index (tag key, tag value) -> positions of the deployments carrying that tag value,
+    # deployments applying to all analytics stories match every object
+    index = {}
+    match_all = []
+    for position, deployment in enumerate(deployments):
         if 'analytics_story' in deployment['tags']:
-            if type(deployment['tags']['analytics_story']) is str:
-                tags_all_array = [deployment['tags']['analytics_story']]
-            else:
-                tags_all_array = deployment['tags']['analytics_story']
-            if tags_all_array[0] == 'all':
-                matched_deployments.append(deployment)
+            if tag_values(deployment['tags']['analytics_story'])[0] == 'all':
+                match_all.append(position)
                 continue
 
-        for tag in object['tags'].keys():
-            if tag in deployment['tags'].keys():
-                if type(object['tags'][tag]) is str:
-                    tag_array = [object['tags'][tag]]
-                else:
-                    tag_array = object['tags'][tag]
+        for tag, value in deployment['tags'].items():
+            for tag_value_deployment in tag_values(value):
+                index.setdefault(tag_index_key(tag, tag_value_deployment), set()).add(position)
 
-                for tag_value in tag_array:
-                    if type(deployment['tags'][tag]) is str:
-                        tag_array_deployment = [deployment['tags'][tag]]
-                    else:
-                        tag_array_deployment = deployment['tags'][tag]
+    return {'deployments': deployments, 'index': index, 'match_all': match_all}
 
-                    for tag_value_deployment in tag_array_deployment:
-                        if tag_value == tag_value_deployment:
-                            matched_deployments.append(deployment)
-                            continue
 
-    return matched_deployments
+def get_deployments(object, deployment_index):
+    # matched deployments in manifest order, so the last one keeps winning like before
+    matched_positions = set(deployment_index['match_all'])
+    for tag, value in object['tags'].items():
+        for tag_value in tag_values(value):
+            matched_positions.update(deployment_index['index'].get(tag_index_key(tag, tag_value), ()))
+
+    return [deployment_index['deployments'][position] for position in sorted(matched_positions)]
 
 
 def get_nes_fields(search, deployment):
     nes_fields_matches = []
     if 'notable' in deployment['alert_action']:
         if 'nes_fields' in deployment['alert_action']['notable']:
+            fields = parse_search(search).fields
             for field in deployment['alert_action']['notable']['nes_fields']:
-                if (search.find(field + ' ') != -1):
+                if field in fields:
                     nes_fields_matches.append(field)
 
     return nes_fields_matches
 
 
-def map_detection_to_stories(detections):
-    sto_det = {}
-    for detection in detections:
-        if 'analytics_story' in detection['tags']:
-            for story in detection['tags']['analytics_story']:
-                if not (story in sto_det):
-                    sto_det[story] = {str('ESCU - ' + detection['name'] + ' - Rule')}
-                else:
-                    sto_det[story].add(str('ESCU - ' + detection['name'] + ' - Rule'))
-    return sto_det
-
-
-def map_response_tasks_to_stories(response_tasks):
-    sto_res = {}
-    for response_task in response_tasks:
-        if 'tags' in response_task:
-            if 'analytics_story' in response_task['tags']:
-                for story in response_task['tags']['analytics_story']:
-                    if not (story in sto_res):
-                        sto_res[story] = {str('ESCU - ' + response_task['name'])}
-                    else:
-                        sto_res[story].add(str('ESCU - ' + response_task['name']))
-    return sto_res
-
-
-def map_baselines_to_stories(baselines):
-    sto_bas = {}
-    for baseline in baselines:
-        if 'tags' in baseline:
-            if 'analytics_story' in baseline['tags']:
-                for story in baseline['tags']['analytics_story']:
-                    if not (story in sto_bas):
-                        sto_bas[story] = {str('ESCU - ' + baseline['name'])}
-                    else:
-                        sto_bas[story].add(str('ESCU - ' + baseline['name']))
-    return sto_bas
-
 def custom_jinja2_enrichment_filter(string, object):
     customized_string = string
     for key in object.keys():
@@ -396,106 +518,108 @@ def custom_jinja2_enrichment_filter(string, object):
     return customized_string
 
 
-def prepare_stories(stories, detections):
+J2_ENV.filters['custom_jinja2_enrichment_filter'] = custom_jinja2_enrichment_filter
 
-    # enrich stories with information from detections: data_models, mitre_ids, kill_chain_phases, nists
-    sto_to_data_models = {}
-    sto_to_mitre_attack_ids = {}
-    sto_to_kill_chain_phases = {}
-    sto_to_ciss = {}
-    sto_to_nists = {}
-    sto_to_det = {}
-    for detection in detections:
-        if 'analytics_story' in detection['tags']:
-            for story in detection['tags']['analytics_story']:
-                if story in sto_to_det.keys():
-                    sto_to_det[story].add(str('ESCU - ' + detection['name'] + ' - Rule'))
-                else:
-                    sto_to_det[story] = {str('ESCU - ' + detection['name'] + ' - Rule')}
-
-                data_model = parse_data_models_from_search(detection['search'])
-                if data_model:
-                    if story in sto_to_data_models.keys():
-                        sto_to_data_models[story].add(data_model)
-                    else:
-                        sto_to_data_models[story] = {data_model}
 
-                if 'mitre_attack_id' in detection['tags']:
-                    if story in sto_to_mitre_attack_ids.keys():
-                        for mitre_attack_id in detection['tags']['mitre_attack_id']:
-                            sto_to_mitre_attack_ids[story].add(mitre_attack_id)
-                    else:
-                        for mitre_attack_id in detection['tags']['mitre_attack_id']:
-                            sto_to_mitre_attack_ids[story] = {mitre_attack_id}
-
-                if 'kill_chain_phases' in detection['tags']:
-                    if story in sto_to_kill_chain_phases.keys():
-                        for kill_chain in detection['tags']['kill_chain_phases']:
-                            sto_to_kill_chain_phases[story].add(kill_chain)
-                    else:
-                        for kill_chain in detection['tags']['kill_chain_phases']:
-                            sto_to_kill_chain_phases[story] = {kill_chain}
-
-                if 'cis20' in detection['tags']:
-                    if story in sto_to_ciss.keys():
-                        for cis in detection['tags']['cis20']:
-                            sto_to_ciss[story].add(cis)
-                    else:
-                        for cis in detection['tags']['cis20']:
-                            sto_to_ciss[story] = {cis}
-
-                if 'nist' in detection['tags']:
-                    if story in sto_to_nists.keys():
-                        for nist in detection['tags']['nist']:
-                            sto_to_nists[story].add(nist)
-                    else:
-                        for nist in detection['tags']['nist']:
-                            sto_to_nists[story] = {nist}
+def prepare_stories(stories, graph):
 
+    # enrich stories with information from detections: data_models, mitre_ids, kill_chain_phases, nists
     for story in stories:
-        story['detections'] = sorted(sto_to_det[story['name']])
-        if story['name'] in sto_to_data_models:
-            story['data_models'] = sorted(sto_to_data_models[story['name']])
-        if story['name'] in sto_to_mitre_attack_ids:
-            story['mitre_attack'] = sorted(sto_to_mitre_attack_ids[story['name']])
-        if story['name'] in sto_to_kill_chain_phases:
-            story['kill_chain_phases'] = sorted(sto_to_kill_chain_phases[story['name']])
-        if story['name'] in sto_to_ciss:
-            story['cis20'] = sorted(sto_to_ciss[story['name']])
-        if story['name'] in sto_to_nists:
-            story['nist'] = sorted(sto_to_nists[story['name']])
+        aggregates = graph.story(story['name'])
+        story['detections'] = ['ESCU - ' + name + ' - Rule' for name in aggregates['detections']]
+        for key in ['data_models'] + list(AGGREGATE_TAGS):
+            if aggregates[key]:
+                story[key] = aggregates[key]
 
-        keys = ['mitre_attack', 'kill_chain_phases', 'cis20', 'nist']
-        mappings = {}
-        for key in keys:
-            if key in story:
-                mappings[key] = story[key]
-
-        story['mappings'] = mappings
+        story['mappings'] = graph.mappings(story['name'])
 
     return stories
 
 
-def generate_mitre_lookup():
+def build_mitre_rows(techniques, relationships, groups):
+    # index groups and group -> technique relationships by id so this stays linear in the bundle size
+    group_names = {}
+    for group in groups:
+        group_names[group['id']] = group['name']
+
+    technique_groups = {}
+    for relationship in relationships:
+        if relationship['source_ref'].startswith('intrusion-set') and relationship['source_ref'] in group_names:
+            technique_groups.setdefault(relationship['target_ref'], []).append(group_names[relationship['source_ref']])
 
     csv_mitre_rows = [["mitre_id", "technique", "tactics", "groups"]]
+    for technique in techniques:
+        apt_groups = technique_groups.get(technique['id'], [])
+        if len(apt_groups) == 0:
+            apt_groups = ['no']
+        csv_mitre_rows.append([technique['technique_id'], technique['technique'], '|'.join(technique['tactic']).replace('-',' ').title(), '|'.join(apt_groups)])
 
-    lift = attack_client()
-    all_enterprise = lift.get_enterprise(stix_format=False)
-    enterprise_relationships = lift.get_enterprise_relationships()
-    enterprise_groups = lift.get_enterprise_groups()
+    return csv_mitre_rows
 
-    for technique in all_enterprise['techniques']:
-        apt_groups = []
-        for relationship in enterprise_relationships:
-            if (relationship['target_ref'] == technique['id']) and relationship['source_ref'].startswith('intrusion-set'):
-                for group in enterprise_groups:
-                    if relationship['source_ref'] == group['id']:
-                        apt_groups.append(group['name'])
 
-        if len(apt_groups) == 0:
-            apt_groups.append('no')
-        csv_mitre_rows.append([technique['technique_id'], technique['technique'], '|'.join(technique['tactic']).replace('-',' ').title(), '|'.join(apt_groups)])
+def parse_mitre_bundle(bundle):
+    # turns a STIX enterprise-attack bundle into the shapes attack_client returns
+    techniques = []
+    relationships = []
+    groups = []
+    for stix_object in bundle['objects']:
+        if stix_object['type'] == 'attack-pattern':
+            technique_id = [r['external_id'] for r in stix_object.get('external_references', [])
+                            if r.get('source_name') == 'mitre-attack' and 'external_id' in r]
+            if len(technique_id) == 0:
+                continue
+            techniques.append({
+                'id': stix_object['id'],
+                'technique_id': technique_id[0],
+                'technique': stix_object['name'],
+                'tactic': [p['phase_name'] for p in stix_object.get('kill_chain_phases', [])
+                           if p.get('kill_chain_name') == 'mitre-attack'],
+            })
+        elif stix_object['type'] == 'relationship':
+            relationships.append(stix_object)
+        elif stix_object['type'] == 'intrusion-set':
+            groups.append(stix_object)
+
+    return techniques, relationships, groups
+
+
+def load_mitre_rows_offline(bundle_path, cache_path):
+    with open(bundle_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    # the rows only change with the bundle, reuse them until its hash changes
+    if path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['digest'] == digest:
+                return cache['rows']
+        except Exception:
+            pass
+
+    techniques, relationships, groups = parse_mitre_bundle(json.loads(data.decode('utf-8')))
+    csv_mitre_rows = build_mitre_rows(techniques, relationships, groups)
+
+    cache_dir = path.dirname(path.abspath(cache_path))
+    if not path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_path, 'wb') as f:
+        pickle.dump({'digest': digest, 'rows': csv_mitre_rows}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return csv_mitre_rows
+
+
+def generate_mitre_lookup(bundle_path=None):
+
+    if bundle_path:
+        csv_mitre_rows = load_mitre_rows_offline(bundle_path, path.join(path.expanduser(REPO_PATH), MITRE_CACHE_FILE))
+    else:
+        lift = attack_client()
+        all_enterprise = lift.get_enterprise(stix_format=False)
+        enterprise_relationships = lift.get_enterprise_relationships()
+        enterprise_groups = lift.get_enterprise_groups()
+        csv_mitre_rows = build_mitre_rows(all_enterprise['techniques'], enterprise_relationships, enterprise_groups)
 
     with open('lookups/mitre_enrichment.csv', 'w', newline='') as file:
         writer = csv.writer(file)
@@ -511,46 +635,100 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--path", required=True, help="path to security-content repo")
     parser.add_argument("-o", "--output", required=True, help="path to the output directory")
     parser.add_argument("-v", "--verbose", required=False, default=False, action='store_true', help="prints verbose output")
+    parser.add_argument("-j", "--jobs", required=False, default=1, type=int, help="number of processes parsing the manifests and of threads writing the outputs, defaults to 1")
+    parser.add_argument("--cache_file", required=False, default=None, help="path to the parsed manifest cache, defaults to <path>/.cache/manifests.pickle")
+    parser.add_argument("--no_cache", required=False, default=False, action='store_true', help="parse every manifest from scratch and do not touch the cache")
+    parser.add_argument("-m", "--mitre_bundle", required=False, default=None, help="local STIX enterprise-attack bundle (enterprise-attack.json) used to build the Mitre lookup offline")
+    parser.add_argument("--schedule_report", required=False, default=False, action='store_true', help="simulate a day of cron firings of the generated saved searches and print the busiest minutes")
+    parser.add_argument("--spread_schedules", required=False, default=0, type=int, metavar="MINUTES", help="move the cron minute of each saved search by a stable offset below MINUTES, so searches sharing a deployment do not all fire at once")
+    parser.add_argument("-i", "--incremental", required=False, default=False, action='store_true', help="only re-render the stanzas affected by manifests changed since the last incremental build")
 
     # parse them
     args = parser.parse_args()
     REPO_PATH = args.path
     OUTPUT_PATH = args.output
     VERBOSE = args.verbose
-    stories = load_objects("stories/*.yml", VERBOSE)
-    macros = load_objects("macros/*.yml", VERBOSE)
-    lookups = load_objects("lookups/*.yml", VERBOSE)
-    baselines = load_objects("baselines/*.yml", VERBOSE)
-    detections = load_objects("detections/*.yml", VERBOSE)
-    responses = load_objects("responses/*.yml", VERBOSE)
-    response_tasks = load_objects("response_tasks/*.yml", VERBOSE)
-    deployments = load_objects("deployments/*.yml", VERBOSE)
+    JOBS = max(1, args.jobs)
+    if not args.no_cache:
+        CACHE = ManifestCache(args.cache_file or default_cache_file(REPO_PATH))
 
+    executor = ProcessPoolExecutor(max_workers=JOBS) if JOBS > 1 else None
     try:
+        stories = load_objects("stories/*.yml", VERBOSE, executor)
+        macros = load_objects("macros/*.yml", VERBOSE, executor)
+        lookups = load_objects("lookups/*.yml", VERBOSE, executor)
+        baselines = load_objects("baselines/*.yml", VERBOSE, executor)
+        detections = load_objects("detections/*.yml", VERBOSE, executor)
+        responses = load_objects("responses/*.yml", VERBOSE, executor)
+        response_tasks = load_objects("response_tasks/*.yml", VERBOSE, executor)
+        deployments = load_objects("deployments/*.yml", VERBOSE, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if CACHE is not None:
+        CACHE.save()
+
+    if args.incremental:
+        BUILD_STATE = BuildState(default_state_file(REPO_PATH), OUTPUT_PATH)
+        for manifest_type, objects in [('stories', stories), ('macros', macros), ('lookups', lookups),
+                              ('baselines', baselines), ('detections', detections), ('responses', responses),
+                              ('response_tasks', response_tasks), ('deployments', deployments)]:
+            BUILD_STATE.add_manifests(manifest_type, manifest_paths(manifest_type + "/*.yml"), objects)
+        BUILD_STATE.options['spread_schedules'] = args.spread_schedules
+        BUILD_STATE.options['sources'] = sources_digest(glob.glob('bin/jinja2_templates/*.j2') +
+            [path.join(path.dirname(path.abspath(__file__)), source) for source in GENERATOR_SOURCES])
+        CHANGES = BUILD_STATE.changes()
         if VERBOSE:
-            print("generating Mitre lookups")
-        generate_mitre_lookup()
-    except:
-        print("WARNING: Generation of Mitre lookup failed.")
+            print("{0} manifests changed since the last incremental build".format(len(CHANGES)))
 
-    lookups_path = generate_transforms_conf(lookups)
-    lookups_path = generate_collections_conf(lookups)
+    try:
+        if VERBOSE:
+            print("generating Mitre lookups")
+        generate_mitre_lookup(args.mitre_bundle)
+    except Exception as e:
+        print("WARNING: Generation of Mitre lookup failed: {0}".format(e))
 
+    # shared enrichment, the writers below only read the objects
     detections = sorted(detections, key=lambda d: d['name'])
     response_tasks = sorted(response_tasks, key=lambda i: i['name'])
     baselines = sorted(baselines, key=lambda b: b['name'])
-    detection_path = generate_savedsearches_conf(detections, response_tasks, baselines, deployments)
+    enrich_searches(detections, response_tasks, baselines, deployments)
+
+    if args.spread_schedules > 1:
+        spread = spread_schedules(detections + baselines, args.spread_schedules)
+        if VERBOSE:
+            print("spread the cron schedules of {0} searches over {1} minutes".format(spread, args.spread_schedules))
+    if args.schedule_report:
+        for line in schedule_report(detections + baselines):
+            print(line)
 
     stories = sorted(stories, key=lambda s: s['name'])
-    story_path = generate_analytics_story_conf(stories, detections, response_tasks, baselines)
+    graph = ContentGraph(stories, detections, baselines, response_tasks)
+    if VERBOSE:
+        for story_name, names in sorted(graph.unknown_stories().items()):
+            print("WARNING: analytics_story {0} of {1} has no story manifest".format(story_name, ", ".join(names)))
+    stories = enrich_stories(stories, graph)
 
-    use_case_lib_path = generate_use_case_library_conf(stories, detections, response_tasks, baselines)
+    workbench_panel_objects = enrich_workbench_panels(response_tasks)
 
     macros = sorted(macros, key=lambda m: m['name'])
-    macros_path = generate_macros_conf(macros, detections)
-
-    generate_workbench_panels(response_tasks, stories)
 
+    lookups_path, collections_path, detection_path, story_path, use_case_lib_path, macros_path, \
+        panels_path, investigations_path, workflow_actions_path = run_writers([
+            (generate_transforms_conf, (lookups,)),
+            (generate_collections_conf, (lookups,)),
+            (generate_savedsearches_conf, (detections, response_tasks, baselines)),
+            (generate_analytics_story_conf, (stories,)),
+            (generate_use_case_library_conf, (stories, detections, response_tasks, baselines)),
+            (generate_macros_conf, (macros, detections)),
+            (generate_workbench_panels, (workbench_panel_objects,)),
+            (generate_es_investigations_conf, (workbench_panel_objects, stories)),
+            (generate_workflow_actions_conf, (workbench_panel_objects,)),
+        ])
+
+    if BUILD_STATE is not None:
+        BUILD_STATE.save()
 
     if VERBOSE:
         print("{0} stories have been successfully written to {1}".format(len(stories), story_path))
@@ -0,0 +1,224 @@
+'''
+Incremental build support for generate.py. Tracks which manifests changed since the last build and
+which .conf stanzas depend on them, and splices re-rendered stanzas into the existing outputs.
+'''
+
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+from os import path
+
+
+STATE_VERSION = 1
+DEFAULT_STATE_FILE = '.cache/build_state.pickle'
+
+# confs that can be updated stanza by stanza
+SPLICEABLE_CONFS = ['savedsearches.conf', 'analytic_stories.conf', 'use_case_library.conf', 'macros.conf']
+
+STANZA_HEADER = re.compile(r'^\[(.+)\]$')
+
+
+def default_state_file(repo_path):
+    return path.join(path.expanduser(repo_path), DEFAULT_STATE_FILE)
+
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def sources_digest(file_paths):
+    '''Digest of the templates and code rendering the outputs, any change to them invalidates every stanza.'''
+    digest = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        digest.update(path.basename(file_path).encode('utf-8'))
+        digest.update(file_digest(file_path).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def manifest_entry(type, file_path, object):
+    '''Dependency node for a manifest: its digest, name and the stories it feeds into.'''
+    stories = []
+    if isinstance(object.get('tags'), dict) and 'analytics_story' in object['tags']:
+        stories = object['tags']['analytics_story']
+        if isinstance(stories, str):
+            stories = [stories]
+
+    return {
+        'type': type,
+        'name': object.get('name'),
+        'digest': file_digest(file_path),
+        'stories': sorted(stories),
+    }
+
+
+class ChangeSet(object):
+    '''
+    Objects that need re-rendering, by manifest type and name. A conf listed in `full` can not
+    be spliced and is rendered from scratch.
+    '''
+
+    def __init__(self, full=None):
+        self.full = set(full or [])
+        self.names = {}
+        self.stories = set()
+
+    def add(self, entry):
+        self.names.setdefault(entry['type'], set()).add(entry['name'])
+        self.stories.update(entry['stories'])
+
+        if entry['type'] == 'stories':
+            self.stories.add(entry['name'])
+        # a deployment can move any detection or baseline to another schedule
+        if entry['type'] == 'deployments':
+            self.full.add('savedsearches.conf')
+
+    def select(self, type, objects):
+        names = self.stories if type == 'stories' else self.names.get(type, set())
+        return [o for o in objects if o['name'] in names]
+
+    def __len__(self):
+        return sum(len(names) for names in self.names.values())
+
+
+class BuildState(object):
+    '''Manifest dependency graph and output digests of the previous build into one output path.'''
+
+    def __init__(self, state_file, output_path):
+        self.state_file = state_file
+        self.output_key = path.abspath(output_path)
+        self.builds = {}
+        self.previous = None
+        self.manifests = {}
+        self.outputs = {}
+        # generate.py options, templates and code digest, changing the output of every stanza
+        self.options = {}
+
+        if path.isfile(state_file):
+            try:
+                with open(state_file, 'rb') as f:
+                    state = pickle.load(f)
+                if state.get('version') == STATE_VERSION:
+                    self.builds = state['builds']
+            except Exception:
+                self.builds = {}
+
+        self.previous = self.builds.get(self.output_key)
+
+    def add_manifests(self, type, manifest_files, objects):
+        for file_path, object in zip(manifest_files, objects):
+            self.manifests[path.abspath(file_path)] = manifest_entry(type, file_path, object)
+
+    def changes(self):
+        if self.previous is None or set(self.previous['manifests']) != set(self.manifests) \
+                or self.previous.get('options', {}) != self.options:
+            # first build, manifests were added/removed so stanza order can't be kept by splicing, or new
+            # options, templates or generator code
+            return ChangeSet(full=SPLICEABLE_CONFS)
+
+        changes = ChangeSet()
+        for key, entry in self.manifests.items():
+            previous_entry = self.previous['manifests'][key]
+            if previous_entry['digest'] != entry['digest']:
+                # both the old and the new stories of the object have to be refreshed
+                changes.add(previous_entry)
+                changes.add(entry)
+        return changes
+
+    def can_splice(self, changes, conf, output_path):
+        if conf in changes.full or self.previous is None or not path.isfile(output_path):
+            return False
+        # the output must still be the one we produced, not a hand edit or a checkout
+        return self.previous['outputs'].get(conf) == file_digest(output_path)
+
+    def record_output(self, conf, output_path):
+        self.outputs[conf] = file_digest(output_path)
+
+    def save(self):
+        self.builds[self.output_key] = {'manifests': self.manifests, 'outputs': self.outputs, 'options': self.options}
+
+        state_dir = path.dirname(path.abspath(self.state_file))
+        if not path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix='.build_state-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'version': STATE_VERSION, 'builds': self.builds}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.state_file)
+        except Exception:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def parse_stanzas(lines):
+    '''
+    Returns {stanza name: [(first line, end line), ...]} for a list of conf lines. A stanza runs
+    until the next stanza, the next comment line or the end of the file, trailing blank lines excluded.
+    '''
+    stanzas = {}
+    current = None
+    start = 0
+
+    def close(end):
+        while end > start and lines[end - 1].strip() == '':
+            end -= 1
+        stanzas.setdefault(current, []).append((start, end))
+
+    for i, line in enumerate(lines):
+        match = STANZA_HEADER.match(line)
+        if match or line.startswith('#'):
+            if current is not None:
+                close(i)
+                current = None
+            if match:
+                current = match.group(1)
+                start = i
+
+    if current is not None:
+        close(len(lines))
+
+    return stanzas
+
+
+def splice_conf(output_path, partial_output):
+    '''
+    Replaces the stanzas rendered in partial_output inside the existing output_path. Returns False,
+    leaving the file untouched, when a stanza can't be matched and a full render is needed.
+    '''
+    with open(output_path, 'r') as f:
+        lines = f.read().split('\n')
+    partial_lines = partial_output.split('\n')
+
+    existing = parse_stanzas(lines)
+    replacements = []
+    for name, ranges in parse_stanzas(partial_lines).items():
+        # new stanzas, or duplicated stanza names we can't pair up, need a full render
+        if len(existing.get(name, [])) != len(ranges):
+            return False
+        for existing_range, (start, end) in zip(existing[name], ranges):
+            replacements.append((existing_range, partial_lines[start:end]))
+
+    # splice from the bottom so earlier line numbers stay valid
+    for (start, end), stanza_lines in sorted(replacements, key=lambda r: r[0][0], reverse=True):
+        lines[start:end] = stanza_lines
+
+    # keep the generation date of the header in sync
+    dates = [line for line in partial_lines if line.startswith('# On Date:')]
+    if dates:
+        lines = [dates[0] if line.startswith('# On Date:') else line for line in lines]
+
+    tmp_path = '{0}.{1}.tmp'.format(output_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines))
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return True
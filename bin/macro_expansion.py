@@ -0,0 +1,126 @@
+'''
+Expands the macros of a search into the SPL Splunk actually runs, with the definitions of
+macros/*.yml and the filter macros generated for every detection.
+'''
+
+from spl import TOKEN, split_macro
+
+FILTER_MACRO_DEFINITION = 'search *'
+FILTER_MACRO_DESCRIPTION = 'Update this macro to limit the output results to filter out false positives. '
+
+
+class MacroError(Exception):
+
+    def __init__(self, message, cycle=None):
+        super(MacroError, self).__init__(message)
+        self.cycle = cycle
+
+
+def macro_tokens(text):
+    '''Match objects of the macros of a text, backticks inside quoted strings are not macros.'''
+    return [match for match in TOKEN.finditer(text)
+            if match.lastgroup == 'macro' and len(match.group()) > 1 and match.group().endswith('`')]
+
+
+def filter_macro_name(name):
+    return name.replace(' ', '_').replace('-', '_').replace('.', '_').replace('/', '_').lower() + '_filter'
+
+
+def filter_macros(detections):
+    '''The filter macro generated for each detection, in the order of the detections.'''
+    macros = []
+    for detection in detections:
+        macros.append({
+            'definition': FILTER_MACRO_DEFINITION,
+            'description': FILTER_MACRO_DESCRIPTION,
+            'name': filter_macro_name(detection['name']),
+        })
+    return macros
+
+
+class MacroExpander(object):
+    '''
+    Macro definitions by name and number of arguments, like macros.conf stanzas. Expanded definitions
+    are memoized per macro and arity with their $arg$ placeholders still in place, so every macro is
+    expanded once no matter how many searches use it. Unknown macros are left as they are.
+    '''
+
+    def __init__(self, macros, detections=None):
+        self.definitions = {}
+        self.expansions = {}
+
+        # generated filter macros come last and win, like in macros.conf
+        for macro in macros + filter_macros(detections or []):
+            arguments = macro.get('arguments') or []
+            self.definitions[(macro['name'], len(arguments))] = (arguments, macro.get('definition') or '')
+
+    def expand(self, search, strict=False):
+        '''The search with all macros expanded, raises MacroError on cycles and, if strict, on unknown macros.'''
+        if strict:
+            for name, arity in self.unknown(search):
+                raise MacroError("macro definition for {0}({1}) can't be found".format(name, arity))
+        return self._expand_text(search, ())
+
+    def unknown(self, search):
+        '''(name, arity) of the macros of a search, nested ones included, without a definition.'''
+        unknown = []
+        self._walk(search, (), unknown)
+        return unknown
+
+    def cycles(self):
+        '''An error for every cycle of macros expanding into each other, reported once per cycle.'''
+        errors = []
+        seen = set()
+        for key in sorted(self.definitions):
+            try:
+                self._expand_macro(key, ())
+            except MacroError as exc:
+                if frozenset(exc.cycle) not in seen:
+                    seen.add(frozenset(exc.cycle))
+                    errors.append(str(exc))
+        return errors
+
+    def _expand_text(self, text, stack):
+        parts = []
+        position = 0
+        for match in macro_tokens(text):
+            parts.append(text[position:match.start()])
+            position = match.end()
+
+            name, args = split_macro(match.group())
+            key = (name, len(args))
+            if key not in self.definitions:
+                parts.append(match.group())
+                continue
+
+            arguments, _ = self.definitions[key]
+            expansion = self._expand_macro(key, stack)
+            for argument, value in zip(arguments, args):
+                expansion = expansion.replace('$' + argument + '$', value)
+            # values passed in may hold macros of their own
+            if any('`' in value for value in args):
+                expansion = self._expand_text(expansion, stack + (key,))
+            parts.append(expansion)
+
+        parts.append(text[position:])
+        return ''.join(parts)
+
+    def _expand_macro(self, key, stack):
+        if key in stack:
+            cycle = [name for name, arity in stack[stack.index(key):]] + [key[0]]
+            raise MacroError("macro cycle: " + " -> ".join(cycle), cycle)
+
+        if key not in self.expansions:
+            _, definition = self.definitions[key]
+            self.expansions[key] = self._expand_text(definition, stack + (key,))
+        return self.expansions[key]
+
+    def _walk(self, text, stack, unknown):
+        for match in macro_tokens(text):
+            name, args = split_macro(match.group())
+            key = (name, len(args))
+            if key not in self.definitions:
+                if key not in unknown:
+                    unknown.append(key)
+            elif key not in stack:
+                self._walk(self.definitions[key][1], stack + (key,), unknown)
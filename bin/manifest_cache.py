@@ -0,0 +1,118 @@
+'''
+Persistent cache of parsed manifests shared by generate.py, validate.py, doc-gen.py and generate-coverage-map.py.
+'''
+
+import hashlib
+import os
+import pickle
+import tempfile
+from os import path
+
+import yaml
+
+
+# bump whenever the layout of the cache or the way manifests are parsed changes
+CACHE_VERSION = 1
+DEFAULT_CACHE_FILE = '.cache/manifests.pickle'
+
+MISS = object()
+
+
+def default_cache_file(repo_path):
+    return path.join(path.expanduser(repo_path), DEFAULT_CACHE_FILE)
+
+
+def parse_manifest(data):
+    # same semantics as the load_file() helpers: only the first document counts
+    return list(yaml.safe_load_all(data))[0]
+
+
+class ManifestCache(object):
+    '''
+    Parsed manifests keyed by absolute path. An entry is reused as long as the file mtime and size
+    are unchanged, or, when those moved, as long as the sha256 of the content is unchanged.
+    Objects are stored pickled so every caller gets its own copy and can enrich it freely.
+    '''
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.dirty = False
+
+        if path.isfile(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache.get('version') == (CACHE_VERSION, yaml.__version__):
+                    self.entries = cache['entries']
+            except Exception:
+                # a corrupt or foreign cache is simply rebuilt
+                self.entries = {}
+
+    @staticmethod
+    def _stat(file_path):
+        st = os.stat(file_path)
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, file_path):
+        key = path.abspath(file_path)
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISS
+
+        stat = self._stat(file_path)
+        if entry['stat'] != stat:
+            with open(file_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            if digest != entry['digest']:
+                return MISS
+            entry['stat'] = stat
+            self.dirty = True
+
+        return pickle.loads(entry['object'])
+
+    def put(self, file_path, object, data=None):
+        stat = self._stat(file_path)
+        if data is None:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+
+        self.entries[path.abspath(file_path)] = {
+            'stat': stat,
+            'digest': hashlib.sha256(data).hexdigest(),
+            'object': pickle.dumps(object, protocol=pickle.HIGHEST_PROTOCOL),
+        }
+        self.dirty = True
+
+    def load(self, file_path):
+        '''Returns the parsed manifest, raises yaml.YAMLError like yaml.safe_load_all would.'''
+        object = self.get(file_path)
+        if object is not MISS:
+            return object
+
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        object = parse_manifest(data)
+        self.put(file_path, object, data)
+        return object
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        cache_dir = path.dirname(path.abspath(self.cache_file))
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # write to a temp file and rename so concurrent tools never read a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.manifests-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'version': (CACHE_VERSION, yaml.__version__), 'entries': self.entries},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_file)
+        except Exception:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.dirty = False
@@ -0,0 +1,157 @@
+'''
+Simulates a day of cron firings of the scheduled searches generate.py writes to savedsearches.conf,
+to find the minutes where the search head scheduler gets more searches than it can start at once,
+and spreads the cron minutes of the searches sharing a schedule deterministically.
+'''
+
+import datetime
+import hashlib
+
+
+# (lowest, highest) value of the minute, hour, day of month, month and day of week cron fields
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+MINUTES_PER_DAY = 24 * 60
+
+
+class CronError(Exception):
+    pass
+
+
+def parse_cron_field(field, lowest, highest):
+    '''The set of values matched by one cron field: *, n, a-b, with an optional /step, comma separated.'''
+    values = set()
+    for part in field.split(','):
+        range_part, _, step = part.partition('/')
+        try:
+            step = int(step) if step else 1
+            if range_part == '*':
+                start, end = lowest, highest
+            elif '-' in range_part:
+                start, end = [int(value) for value in range_part.split('-', 1)]
+            else:
+                start = int(range_part)
+                end = highest if step > 1 else start
+        except ValueError:
+            raise CronError("can't parse cron field {0}".format(field))
+        if start < lowest or end > highest or start > end or step < 1:
+            raise CronError("cron field {0} is out of range {1}-{2}".format(field, lowest, highest))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(cron_schedule):
+    '''Minutes, hours, days of month, months and days of week of a 5 field cron schedule.'''
+    fields = cron_schedule.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise CronError("cron schedule {0} needs {1} fields".format(cron_schedule, len(CRON_FIELDS)))
+
+    values = [parse_cron_field(field, lowest, highest) for field, (lowest, highest) in zip(fields, CRON_FIELDS)]
+    # 7 is sunday too
+    if 7 in values[4]:
+        values[4] = (values[4] - set([7])) | set([0])
+    return values
+
+
+def fires_on(cron_schedule, day):
+    '''Minutes of the day, counted from midnight, a cron schedule fires at on a date.'''
+    minutes, hours, days, months, weekdays = parse_cron(cron_schedule)
+    day_fields = cron_schedule.split()[2:5:2]
+
+    if day.month not in months:
+        return []
+    # when both the day of month and the day of week are restricted, either one matching is enough
+    day_of_month = day.day in days
+    day_of_week = day.isoweekday() % 7 in weekdays
+    if '*' not in day_fields:
+        matches = day_of_month or day_of_week
+    elif day_fields[0] != '*':
+        matches = day_of_month
+    else:
+        matches = day_of_week
+    if not matches:
+        return []
+
+    return sorted(hour * 60 + minute for hour in hours for minute in minutes)
+
+
+def simulate_day(searches, day=None):
+    '''The searches started at each minute of a day, searches being (name, cron schedule, ...) tuples.'''
+    day = day or datetime.date.today()
+    firings = [[] for _ in range(MINUTES_PER_DAY)]
+    for search in searches:
+        for minute in fires_on(search[1], day):
+            firings[minute].append(search)
+    return firings
+
+
+def scheduled_searches(objects):
+    '''(name, cron schedule, deployment name) of the detections and baselines with a deployment.'''
+    searches = []
+    for object in objects:
+        if 'deployment' in object and 'cron_schedule' in object['deployment'].get('scheduling', {}):
+            searches.append((object['name'], object['deployment']['scheduling']['cron_schedule'], object['deployment']['name']))
+    return searches
+
+
+def schedule_report(objects, day=None, top=5):
+    '''Lines describing the firings of a day: totals, the peak minute and the busiest minutes.'''
+    searches = scheduled_searches(objects)
+    firings = simulate_day(searches, day)
+
+    busy = sorted(range(MINUTES_PER_DAY), key=lambda minute: (-len(firings[minute]), minute))
+    lines = ["{0} scheduled searches fire {1} times a day, in {2} distinct minutes".format(
+        len(searches), sum(len(started) for started in firings), len([started for started in firings if started]))]
+
+    if firings[busy[0]]:
+        lines.append("peak of {0} concurrent searches at {1:02d}:{2:02d}".format(len(firings[busy[0]]), busy[0] // 60, busy[0] % 60))
+    for minute in busy[:top]:
+        if not firings[minute]:
+            break
+        counts = {}
+        for name, cron_schedule, deployment in firings[minute]:
+            counts[deployment] = counts.get(deployment, 0) + 1
+        lines.append("\t{0:02d}:{1:02d} {2:4d} searches: {3}".format(minute // 60, minute % 60, len(firings[minute]),
+                     ", ".join("{0} from {1}".format(count, deployment) for deployment, count in sorted(counts.items()))))
+    return lines
+
+
+def spread_offset(name, minutes):
+    '''Stable offset in [0, minutes) of a search, the same on every run and every machine.'''
+    return int(hashlib.sha1(name.encode('utf-8')).hexdigest(), 16) % minutes
+
+
+def spread_cron(cron_schedule, offset):
+    '''
+    The cron schedule with its minute moved forward by offset. Only a single fixed minute is moved.
+    Past the hour it carries into a single fixed hour, wrapping around midnight so the search keeps
+    its day, and wraps around the hour for any other hour field.
+    '''
+    fields = cron_schedule.split()
+    if len(fields) != len(CRON_FIELDS) or not fields[0].isdigit():
+        return cron_schedule
+
+    minute = int(fields[0]) + offset
+    if fields[1].isdigit():
+        minute = (int(fields[1]) * 60 + minute) % MINUTES_PER_DAY
+        fields[1] = str(minute // 60)
+    fields[0] = str(minute % 60)
+    return ' '.join(fields)
+
+
+def spread_schedules(objects, minutes):
+    '''
+    Moves the cron minute of every detection and baseline by its own offset of up to minutes - 1, so
+    searches sharing a deployment stop firing in the same minute. Each object gets its own copy of
+    the deployment scheduling, the deployments themselves are left untouched.
+    '''
+    spread = 0
+    for object in objects:
+        if 'deployment' not in object or 'cron_schedule' not in object['deployment'].get('scheduling', {}):
+            continue
+        scheduling = object['deployment']['scheduling']
+        cron_schedule = spread_cron(scheduling['cron_schedule'], spread_offset(object['name'], minutes))
+        if cron_schedule != scheduling['cron_schedule']:
+            object['deployment'] = dict(object['deployment'], scheduling=dict(scheduling, cron_schedule=cron_schedule))
+            spread += 1
+    return spread
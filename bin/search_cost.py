@@ -0,0 +1,125 @@
+'''
+Static cost estimate of a search. Every pattern known to be expensive on the indexers or on the
+search head is a rule with a fixed weight on each side; the findings of a search add up to its cost.
+'''
+
+from macro_expansion import MacroError
+from spl import parse_search
+
+
+# rule id: (indexer cost, search head cost, message)
+RULES = {
+    'leading-wildcard': (3, 0, "leading wildcard in {0}, the indexers scan every term of the lexicon"),
+    'tstats-leading-wildcard': (1, 0, "leading wildcard in {0}, every value of the field in the summaries is scanned"),
+    'unfiltered-raw-search': (2, 0, "raw events are only filtered by index, source, sourcetype or eventtype"),
+    'raw-aggregation': (2, 1, "raw events are aggregated with {0}, tstats over a data model would read the accelerated summaries"),
+    'subsearch': (1, 1, "subsearch of {0} runs first and its results are expanded into the outer search"),
+    'join': (1, 4, "join keeps both sides on the search head and silently truncates the subsearch"),
+    'transaction': (0, 4, "transaction holds events in memory on the search head"),
+    'append': (1, 2, "{0} runs a second search and merges it on the search head"),
+    'map': (2, 5, "map runs a search for every result row"),
+}
+
+SOURCE_FIELDS = ['index', 'source', 'sourcetype', 'eventtype']
+
+# commands tstats could replace when they aggregate raw events
+AGGREGATIONS = ['stats', 'chart', 'timechart', 'top', 'rare']
+
+COSTLY_COMMANDS = {
+    'join': 'join',
+    'transaction': 'transaction',
+    'append': 'append',
+    'appendcols': 'append',
+    'map': 'map',
+}
+
+
+def finding(rule, *args):
+    indexer, search_head, message = RULES[rule]
+    return {'rule': rule, 'message': message.format(*args), 'indexer': indexer, 'search_head': search_head}
+
+
+def pipelines(search):
+    '''(holding command, commands) of the main pipeline, holding command None, and of every subsearch.'''
+    pipelines = []
+    open_pipelines = []
+    for command in search.commands:
+        # commands are listed in the order they start in, a deeper one opens a subsearch
+        while open_pipelines and open_pipelines[-1][1][0].depth > command.depth:
+            open_pipelines.pop()
+        if not open_pipelines or open_pipelines[-1][1][0].depth < command.depth:
+            holder = open_pipelines[-1][1][-1] if open_pipelines else None
+            pipeline = (holder, [command])
+            pipelines.append(pipeline)
+            open_pipelines.append(pipeline)
+        else:
+            open_pipelines[-1][1].append(command)
+    return pipelines
+
+
+def wildcard_terms(command):
+    return ["{0}{1}{2}".format(field, op, value) for field, op, value in command.terms()
+            if op in ('=', '!=') and value.startswith('*') and value.strip('*')]
+
+
+def filters_events(command):
+    '''True if the command narrows events down beyond index, source, sourcetype and eventtype.'''
+    tokens = command.tokens
+    skipped = set()
+    for i in range(1, len(tokens) - 1):
+        if tokens[i][0] == 'operator' and tokens[i - 1][1] in SOURCE_FIELDS:
+            skipped.update([i - 1, i, i + 1])
+
+    for i, (kind, text) in enumerate(tokens):
+        if i in skipped or (i == 0 and text == 'search') or text in ('AND', 'OR', 'NOT'):
+            continue
+        if kind in ('word', 'string', 'macro', 'operator'):
+            return True
+    return False
+
+
+def lint_pipeline(holder, commands):
+    findings = []
+    base = commands[0]
+
+    if holder is not None and holder.name not in COSTLY_COMMANDS:
+        findings.append(finding('subsearch', holder.name))
+
+    if base.name == 'search':
+        for term in wildcard_terms(base):
+            findings.append(finding('leading-wildcard', term))
+        if not filters_events(base):
+            findings.append(finding('unfiltered-raw-search'))
+        aggregations = [command.name for command in commands if command.name in AGGREGATIONS]
+        if aggregations:
+            findings.append(finding('raw-aggregation', aggregations[0]))
+    elif base.name == 'tstats':
+        for term in wildcard_terms(base):
+            findings.append(finding('tstats-leading-wildcard', term))
+
+    for command in commands:
+        if command.name in COSTLY_COMMANDS:
+            findings.append(finding(COSTLY_COMMANDS[command.name], command.name))
+
+    return findings
+
+
+def lint_search(search, expander=None):
+    '''Findings of a search, with its macros expanded first when an expander is given.'''
+    if expander is not None:
+        try:
+            search = expander.expand(search)
+        except MacroError:
+            pass
+
+    findings = []
+    for holder, commands in pipelines(parse_search(search)):
+        findings = findings + lint_pipeline(holder, commands)
+    return findings
+
+
+def search_cost(findings):
+    '''Total, indexer and search head cost of a list of findings.'''
+    indexer = sum(finding['indexer'] for finding in findings)
+    search_head = sum(finding['search_head'] for finding in findings)
+    return indexer + search_head, indexer, search_head
@@ -0,0 +1,291 @@
+'''
+A small SPL lexer for the searches of the security-content manifests. A search is tokenized once
+into its commands, macros, data model references, fields, comparisons and lookups, and the result
+is shared by generate.py and validate.py.
+'''
+
+import re
+
+from functools import lru_cache
+
+
+TOKEN = re.compile(r'''
+    (?P<string>"(?:[^"\\]|\\.)*"?)
+  | (?P<macro>`[^`]*`?)
+  | (?P<pipe>\|)
+  | (?P<lbracket>\[)
+  | (?P<rbracket>\])
+  | (?P<lparen>\()
+  | (?P<rparen>\))
+  | (?P<comma>,)
+  | (?P<operator>==|!=|<=|>=|=|<|>)
+  | (?P<word>[^\s"`|\[\](),=!<>]+)
+  | (?P<other>\S)
+''', re.X)
+
+# a string token holding its closing quote, escaped quotes and backslashes consumed on the way
+CLOSED_STRING = re.compile(r'"(?:[^"\\]|\\.)*"$')
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][\w.]*$')
+
+# words of the search language, never field names
+KEYWORDS = set(['AND', 'OR', 'NOT', 'by', 'BY', 'groupby', 'as', 'AS', 'where', 'WHERE', 'from', 'FROM', 'OUTPUT', 'OUTPUTNEW'])
+
+LOOKUP_COMMANDS = ['lookup', 'inputlookup', 'outputlookup']
+
+# commands comparing fields, the name=value pairs of any other command are options up to a where clause
+COMPARISON_COMMANDS = ['search', 'where', 'eval', 'regex']
+
+# commands whose plain arguments are field names
+FIELD_LIST_COMMANDS = ['table', 'fields', 'dedup', 'sort', 'rename', 'mvexpand', 'fillnull', 'makemv', 'iplocation', 'spath', 'lookup']
+
+# options naming the field a command reads or writes
+FIELD_OPTIONS = ['field', 'input', 'output', 'path']
+
+# parser states: start of a pipeline, command name expected after a pipe, inside a command
+START, COMMAND, ARGUMENTS = range(3)
+
+
+def tokenize(search):
+    '''List of (kind, text) tokens, kind being one of the TOKEN group names.'''
+    return [(match.lastgroup, match.group()) for match in TOKEN.finditer(search)]
+
+
+def unquote(text):
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+
+def split_macro(text):
+    '''Name and argument list of a `macro` or `macro(arg, ...)` token.'''
+    body = text.strip('`').strip()
+    if not body.endswith(')') or '(' not in body:
+        return body, []
+
+    name, _, args = body[:-1].partition('(')
+    arguments = []
+    current = []
+    quoted = False
+    for char in args:
+        if char == '"':
+            quoted = not quoted
+        if char == ',' and not quoted:
+            arguments.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    arguments.append(''.join(current).strip())
+
+    return name.strip(), arguments
+
+
+class Command(object):
+    '''
+    One command of a pipeline: its lowercase name, None for a macro in command position, how deep
+    in subsearches it sits and its own tokens, those of its subsearches excluded.
+    '''
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.tokens = []
+
+    def terms(self):
+        '''(field, operator, value) of every comparison, quotes stripped from the value.'''
+        terms = []
+        tokens = self.tokens
+        for i in range(1, len(tokens) - 1):
+            if tokens[i][0] == 'operator' and tokens[i - 1][0] == 'word' and tokens[i + 1][0] in ('word', 'string', 'macro'):
+                terms.append((unquote(tokens[i - 1][1]), tokens[i][1], unquote(tokens[i + 1][1])))
+        return terms
+
+    def arguments(self):
+        '''Leading name=value options of the command, and the tokens following them.'''
+        options = {}
+        tokens = self.tokens
+        i = 0
+        while i + 2 < len(tokens) and tokens[i][0] == 'word' and tokens[i + 1] == ('operator', '='):
+            options[tokens[i][1]] = unquote(tokens[i + 2][1])
+            i += 3
+        return options, tokens[i:]
+
+    def fields(self):
+        '''
+        Words the command uses as field names: left-hand sides of comparisons, by clauses, field
+        lists, as targets and bare function arguments. Values, options and function names are left out.
+        '''
+        fields = []
+        tokens = self.tokens
+        comparisons = self.name in COMPARISON_COMMANDS
+        by = False
+        # the lookup table of a lookup command comes right after its options
+        options, arguments = self.arguments()
+        table = len(tokens) - len(arguments) if self.name == 'lookup' else None
+        fields.extend(value for name, value in options.items() if name in FIELD_OPTIONS)
+        # for every open parenthesis, whether it holds the arguments of a function
+        calls = []
+        for i, (kind, text) in enumerate(tokens):
+            previous = tokens[i - 1] if i > 0 else (None, None)
+            following = tokens[i + 1] if i + 1 < len(tokens) else (None, None)
+            if kind == 'lparen':
+                calls.append(previous[0] == 'word')
+            elif kind == 'rparen' and calls:
+                calls.pop()
+            if kind != 'word' or previous[0] == 'operator' or i == table:
+                continue
+
+            if text.lower() == 'where':
+                comparisons = True
+                by = False
+            elif text in ('by', 'BY', 'groupby'):
+                by = True
+            elif following[0] == 'operator':
+                # options like span= may follow the fields of a by clause
+                if comparisons and not by:
+                    fields.append(text)
+            elif following[0] == 'lparen':
+                # function name
+                continue
+            elif by or self.name in FIELD_LIST_COMMANDS or previous[1] in ('as', 'AS'):
+                fields.append(text)
+            elif calls and calls[-1] and previous[0] in ('lparen', 'comma') and following[0] in ('comma', 'rparen'):
+                fields.append(text)
+        return fields
+
+
+class Search(object):
+    '''
+    A tokenized search. Commands are listed in the order they start in, so the commands of a
+    subsearch come right after the command holding it.
+    '''
+
+    def __init__(self, search):
+        self.search = search
+        self.tokens = tokenize(search)
+        self.commands = []
+        self.macros = []
+        self.fields = set()
+        self._parse()
+
+    def _parse(self):
+        stack = []
+        state = START
+        command = None
+
+        for kind, text in self.tokens:
+            if kind == 'macro':
+                name, args = split_macro(text)
+                self.macros.append((name, args))
+                for arg in args:
+                    self._add_field(arg)
+
+            if kind == 'pipe':
+                state = COMMAND
+                continue
+            if kind == 'lbracket':
+                stack.append(command)
+                state = START
+                continue
+            if kind == 'rbracket' and stack:
+                command = stack.pop()
+                state = ARGUMENTS
+                continue
+
+            if state == START:
+                # a pipeline not starting with a pipe runs the implicit search command
+                command = self._add_command('search', len(stack))
+            elif state == COMMAND:
+                if kind == 'word':
+                    command = self._add_command(text.lower(), len(stack))
+                    state = ARGUMENTS
+                    continue
+                command = self._add_command(None, len(stack))
+            state = ARGUMENTS
+
+            command.tokens.append((kind, text))
+
+        for command in self.commands:
+            for field in command.fields():
+                self._add_field(field)
+
+    def _add_command(self, name, depth):
+        command = Command(name, depth)
+        self.commands.append(command)
+        return command
+
+    def _add_field(self, text):
+        text = unquote(text)
+        if text in KEYWORDS or not IDENTIFIER.match(text):
+            return
+        self.fields.add(text)
+        # Processes.dest is also known as dest once the data model prefix is dropped
+        if '.' in text:
+            self.fields.add(text.rsplit('.', 1)[1])
+
+    def command_names(self):
+        return [command.name for command in self.commands if command.name is not None]
+
+    def macro_names(self):
+        return [name for name, args in self.macros]
+
+    def unterminated(self):
+        '''Macros and quoted strings missing their closing backtick or quote.'''
+        return [text for kind, text in self.tokens
+                if (kind == 'macro' and (len(text) < 2 or not text.endswith('`')))
+                or (kind == 'string' and not CLOSED_STRING.match(text))]
+
+    def terms(self):
+        '''(command name, field, operator, value) of every comparison of the search.'''
+        return [(command.name,) + term for command in self.commands for term in command.terms()]
+
+    def data_models(self):
+        '''(data model, dataset) of every `from datamodel=`, `datamodel` and `from datamodel:` reference.'''
+        references = []
+        for command in self.commands:
+            tokens = command.tokens
+            for i, (kind, text) in enumerate(tokens):
+                previous = tokens[i - 1][1].lower() if i > 0 else command.name
+                if kind != 'word' or previous != 'from':
+                    continue
+                reference = None
+                if text.lower() == 'datamodel' and i + 2 < len(tokens) and tokens[i + 1] == ('operator', '='):
+                    reference = unquote(tokens[i + 2][1])
+                elif text.lower().startswith('datamodel:'):
+                    reference = text[len('datamodel:'):]
+                    if not reference and i + 1 < len(tokens):
+                        reference = unquote(tokens[i + 1][1])
+                if reference:
+                    data_model, _, dataset = reference.partition('.')
+                    references.append((data_model, dataset))
+
+            if command.name == 'datamodel':
+                _, arguments = command.arguments()
+                words = [unquote(text) for kind, text in arguments if kind in ('word', 'string')]
+                if words:
+                    references.append((words[0], words[1] if len(words) > 1 and words[1] != 'search' else ''))
+
+        return references
+
+    def data_model(self):
+        '''The first data model the search reads from, or False.'''
+        references = self.data_models()
+        if references:
+            return references[0][0]
+        return False
+
+    def lookups(self):
+        '''(command, lookup name or file) of every lookup, inputlookup and outputlookup.'''
+        lookups = []
+        for command in self.commands:
+            if command.name in LOOKUP_COMMANDS:
+                _, arguments = command.arguments()
+                if arguments and arguments[0][0] in ('word', 'string'):
+                    lookups.append((command.name, unquote(arguments[0][1])))
+        return lookups
+
+
+@lru_cache(maxsize=None)
+def parse_search(search):
+    '''The parsed search, tokenized once per distinct search string. Treat it as read only.'''
+    return Search(search)
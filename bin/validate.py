@@ -5,6 +5,7 @@ Validates Manifest file under the security-content repo for correctness.
 '''
 
 import glob
+import csv
 import json
 import jsonschema
 import yaml
@@ -13,41 +14,199 @@ import argparse
 import datetime
 import string
 import re
+import subprocess
+import time
+from functools import partial
 from os import path
+from concurrent.futures import ProcessPoolExecutor
+from manifest_cache import ManifestCache, MISS, default_cache_file, parse_manifest
+from spl import parse_search
+from macro_expansion import MacroExpander, filter_macro_name
+from validation_report import Report, error, timed
+from search_cost import lint_search, search_cost
 
 
-def validate_schema(REPO_PATH, type, objects):
+# compiled validators by schema file, the meta-schema check and validator construction happen once per spec
+VALIDATORS = {}
 
-    error = False
+JOBS = 1
+
+# lookups shipped with Enterprise Security rather than declared under lookups/
+EXTERNAL_LOOKUPS = ['alexa_lookup_by_str', 'asset_lookup_by_str', 'identity_lookup_expanded', 'interesting_ports_lookup', 'interesting_processes_lookup']
+
+# fields a search should get from a source macro instead
+SOURCE_FIELDS = ['eventtype', 'sourcetype', 'source', 'index']
+
+# lookups beyond these limits bloat the knowledge bundle replicated to every search peer
+LOOKUP_MAX_SIZE = 10 * 1024 * 1024
+LOOKUP_MAX_ROWS = 500000
+
+# highest estimated cost of a detection search, None to only report the costs
+MAX_SEARCH_COST = None
+
+MATCH_TYPE = re.compile(r'^(WILDCARD|CIDR|EXACT)\(([^()\s]+)\)$')
+
+
+class ChangedManifests(object):
+    '''
+    Files changed against a git revision, deleted files included, and the objects parsed from the
+    changed manifests. A renamed file counts as its old path deleted and its new path added, so
+    references to the old name are checked too.
+    '''
+
+    def __init__(self, repo_path, rev, files):
+        self.repo_path = path.abspath(repo_path)
+        self.rev = rev
+        self.files = set(path.abspath(file) for file in files)
+        self.objects = []
+
+    def __contains__(self, file_path):
+        return path.abspath(file_path) in self.files
+
+    def __len__(self):
+        return len(self.objects)
+
+    def add(self, object):
+        self.objects.append(object)
+
+    def previous_objects(self, type):
+        '''The changed and deleted manifests of a type as they were at the revision.'''
+        objects = []
+        type_path = path.join(self.repo_path, type)
+        for file in sorted(self.files):
+            if path.dirname(file) != type_path or not file.endswith('.yml'):
+                continue
+            try:
+                data = subprocess.check_output(['git', 'show', '{0}:./{1}'.format(self.rev, path.relpath(file, self.repo_path))],
+                                               cwd=self.repo_path, stderr=subprocess.DEVNULL)
+                object = parse_manifest(data)
+            except (subprocess.CalledProcessError, yaml.YAMLError, IndexError):
+                # added since the revision, or broken back then
+                continue
+            if isinstance(object, dict) and 'name' in object:
+                objects.append(object)
+        return objects
+
+
+def changed_manifests(REPO_PATH, rev):
+    repo_path = path.expanduser(REPO_PATH)
+    try:
+        # committed and uncommitted changes since rev, plus files git doesn't know yet; without rename
+        # detection a renamed file is listed under its old path as well as its new one
+        changed = subprocess.check_output(['git', 'diff', '--name-only', '--no-renames', '--relative', rev, '--'], cwd=repo_path)
+        untracked = subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard'], cwd=repo_path)
+    except (OSError, subprocess.CalledProcessError):
+        sys.exit("ERROR: can't list the files of {0} changed since {1}".format(REPO_PATH, rev))
+
+    files = (changed + untracked).decode('utf-8').splitlines()
+    return ChangedManifests(repo_path, rev, [path.join(repo_path, file) for file in files if file])
+
+
+def load_manifest(manifest_file, cache=None):
+    if cache is not None:
+        return cache.load(manifest_file)
+    with open(manifest_file, 'r') as stream:
+        return list(yaml.safe_load_all(stream))[0]
+
+
+def load_validator(schema_file):
+    if schema_file not in VALIDATORS:
+        with open(schema_file, 'rb') as f:
+            schema = json.loads(f.read())
+        # pick the draft from $schema like jsonschema.validate() does, defaulting to draft 7
+        validator_class = jsonschema.validators.validator_for(schema, default=jsonschema.Draft7Validator)
+        validator_class.check_schema(schema)
+        VALIDATORS[schema_file] = validator_class(schema)
+    return VALIDATORS[schema_file]
+
+
+def map_checks(executor, check, items):
+    # shard the checks over the process pool, map keeps the input order so the output is stable
+    if executor is not None and len(items) > 1:
+        chunksize = max(1, len(items) // (JOBS * 4))
+        return executor.map(check, items, chunksize=chunksize)
+    return map(check, items)
+
+
+def check_manifest(schema_file, manifest):
+    '''
+    Parses the manifest unless the cached object came along and, if asked to, validates it against
+    its spec. Returns (object, parsed, schema errors, read error).
+    '''
+    manifest_file, object, check = manifest
+    parsed = object is None
+    if parsed:
+        try:
+            object = load_manifest(manifest_file)
+        except yaml.YAMLError as exc:
+            return None, parsed, [], str(exc)
+
+    if not check:
+        return object, parsed, [], None
+
+    # report every violation of the file, not only the first one
+    errors = []
+    for json_ve in sorted(load_validator(schema_file).iter_errors(object), key=lambda e: list(e.path)):
+        errors.append(error('schema-' + str(json_ve.validator), "ERROR: {0} at:\n\t{1}".format(json.dumps(json_ve.message), manifest_file)))
+
+    return object, parsed, errors, None
+
+
+def validate_schema(REPO_PATH, type, objects, cache=None, executor=None, changed=None, report=None):
+
+    schema_error = False
     errors = []
+    report = Report() if report is None else report
+    start = time.perf_counter()
 
     schema_file = path.join(path.expanduser(REPO_PATH), 'spec/' + type + '.spec.json')
 
     try:
-        schema = json.loads(open(schema_file, 'rb').read())
+        load_validator(schema_file)
+        schema_loaded = True
     except IOError:
         print("ERROR: reading schema file {0}".format(schema_file))
+        report.add('schema', 'schema', schema_file, 0.0, [error('schema-file', "ERROR: reading schema file {0}".format(schema_file))])
+        schema_loaded = False
+        schema_error = True
 
-    manifest_files = path.join(path.expanduser(REPO_PATH), type + '/*.yml')
+    manifest_files = sorted(glob.glob(path.join(path.expanduser(REPO_PATH), type + '/*.yml')))
 
-    for manifest_file in glob.glob(manifest_files):
-        if verbose:
+    # with a change set only the changed manifests are validated, the others are still loaded
+    # (from the cache when possible) for the cross-reference checks
+    checks = [changed is None or manifest_file in changed or schema_file in changed for manifest_file in manifest_files]
+
+    manifests = []
+    for manifest_file, check in zip(manifest_files, checks):
+        if verbose and check:
             print("processing manifest {0}".format(manifest_file))
+        object = cache.get(manifest_file) if cache is not None else MISS
+        # without a spec the manifests are only loaded
+        manifests.append((manifest_file, None if object is MISS else object, check and schema_loaded))
 
-        with open(manifest_file, 'r') as stream:
-            try:
-                object = list(yaml.safe_load_all(stream))[0]
-            except yaml.YAMLError as exc:
-                print(exc)
-                print("Error reading {0}".format(manifest_file))
-                error = True
-                continue
+    results = map_checks(executor, partial(timed, partial(check_manifest, schema_file)), manifests)
 
-        try:
-            jsonschema.validate(instance=object, schema=schema)
-        except jsonschema.exceptions.ValidationError as json_ve:
-            errors.append("ERROR: {0} at:\n\t{1}".format(json.dumps(json_ve.message), manifest_file))
-            error = True
+    for manifest_file, check, ((object, parsed, manifest_errors, read_error), seconds) in zip(manifest_files, checks, results):
+        if read_error is not None:
+            print(read_error)
+            print("Error reading {0}".format(manifest_file))
+            report.add('schema', 'yaml', manifest_file, seconds, [error('yaml', "ERROR: reading {0}: {1}".format(manifest_file, read_error))])
+            schema_error = True
+            continue
+
+        report.add_file(object, manifest_file)
+        if check and schema_loaded:
+            report.add('schema', 'schema', manifest_file, seconds, manifest_errors)
+
+        if parsed and cache is not None:
+            cache.put(manifest_file, object)
+
+        if manifest_errors:
+            errors = errors + manifest_errors
+            schema_error = True
+
+        if changed is not None and check:
+            changed.add(object)
 
         if type in objects:
             objects[type].append(object)
@@ -56,28 +215,138 @@ def validate_schema(REPO_PATH, type, objects):
             arr.append(object)
             objects[type] = arr
 
-    return objects, error, errors
+    report.add_phase('schema', time.perf_counter() - start)
 
+    return objects, schema_error, errors
 
-def validate_objects(REPO_PATH, objects):
 
-    # uuids
-    uuids = []
+def run_checks(report, phase, name, check, objects, executor=None):
+    '''Runs check on every object, in the pool if there is one, and records each run in the report.'''
     errors = []
+    start = time.perf_counter()
+
+    for object, (object_errors, seconds) in zip(objects, map_checks(executor, partial(timed, check), objects)):
+        report.add(phase, name, report.file(object), seconds, object_errors)
+        errors.extend(object_errors)
 
+    report.add_phase(phase, time.perf_counter() - start)
+    return errors
+
+
+def build_index(objects):
+    '''
+    Macros and lookups by name, lookups by file name and the lookups the searches create themselves
+    with outputlookup, built once and shared by every cross-reference check.
+    '''
+    index = {
+        'macros': dict((macro['name'], macro) for macro in objects['macros']),
+        'lookups': dict((lookup['name'], lookup) for lookup in objects['lookups']),
+        'lookup_files': dict((lookup['filename'], lookup) for lookup in objects['lookups'] if 'filename' in lookup),
+        'output_lookups': set(),
+    }
+
+    for object in objects['detections'] + objects['baselines']:
+        for command, name in parse_search(object['search']).lookups():
+            if command == 'outputlookup':
+                index['output_lookups'].add(name)
+
+    return index
+
+
+def select_changed(REPO_PATH, objects, changed):
+    '''
+    The objects of the changed manifests, the lookups whose csv file changed and the detections and
+    baselines referencing a changed macro or lookup under its current or previous name, by type.
+    '''
+    selected = set(id(object) for object in changed.objects)
+
+    lookups_path = path.join(path.expanduser(REPO_PATH), 'lookups')
     for lookup in objects['lookups']:
-        lookup_errors = validate_lookups_content(REPO_PATH, "lookups/%s", lookup)
+        if 'filename' in lookup and path.join(lookups_path, lookup['filename']) in changed:
+            selected.add(id(lookup))
+
+    # a renamed or deleted macro or lookup breaks the searches using its old name
+    macros = set(macro['name'] for macro in objects['macros'] if id(macro) in selected)
+    macros.update(macro['name'] for macro in changed.previous_objects('macros'))
+    lookups = set()
+    for lookup in [lookup for lookup in objects['lookups'] if id(lookup) in selected] + changed.previous_objects('lookups'):
+        lookups.add(lookup['name'])
+        lookups.add(lookup.get('filename'))
+
+    for object in objects['detections'] + objects['baselines']:
+        search = parse_search(object['search'])
+        if macros.intersection(search.macro_names()) or any(name in lookups for command, name in search.lookups()):
+            selected.add(id(object))
+
+    return dict((type, [object for object in objects[type] if id(object) in selected]) for type in objects)
+
+
+def validate_objects(REPO_PATH, objects, executor=None, changed=None, report=None):
 
+    # uuids
+    uuids = set()
+    errors = []
+    report = Report() if report is None else report
+
+    start = time.perf_counter()
+    index = build_index(objects)
+    selected = objects if changed is None else select_changed(REPO_PATH, objects, changed)
+    report.add_phase('index', time.perf_counter() - start)
+
+    check_lookup = partial(validate_lookups_content, REPO_PATH, "lookups/%s", max_size=LOOKUP_MAX_SIZE, max_rows=LOOKUP_MAX_ROWS)
+    lookup_errors = run_checks(report, 'lookups', 'lookup content', check_lookup, selected['lookups'], executor)
+
+    start = time.perf_counter()
+
+    # duplicate uuids depend on the order the objects are seen in, these checks stay in this process
     objects_array = objects['stories'] + objects['detections'] + objects['baselines'] + objects['response_tasks'] + objects['responses']
-    for object in objects_array:
-        validation_errors, uuids = validate_standard_fields(object, uuids)
+    selected_array = selected['stories'] + selected['detections'] + selected['baselines'] + selected['response_tasks'] + selected['responses']
+    if changed is not None:
+        # unchanged objects were validated before, the changed ones are checked against their ids
+        selected_ids = set(id(object) for object in selected_array)
+        uuids = set(object['id'] for object in objects_array if id(object) not in selected_ids)
+
+    for object in selected_array:
+        (validation_errors, uuids), seconds = timed(partial(validate_standard_fields, uuids=uuids), object)
+        report.add('standard fields', 'standard fields', report.file(object), seconds, validation_errors)
         errors = errors + validation_errors
 
-    for object in objects['detections']:
-        errors = errors + validate_detection_search(object, objects['macros'])
-
-    for object in objects['baselines']:
-        errors = errors + validate_baseline_search(object, objects['macros'])
+    for type in ['macros', 'lookups', 'stories', 'detections', 'baselines', 'response_tasks', 'responses', 'deployments']:
+        selected_ids = set(id(object) for object in selected[type])
+        names = set(object['name'] for object in objects[type] if id(object) not in selected_ids)
+        for object in selected[type]:
+            validation_errors, seconds = timed(partial(validate_unique_name, type, names=names), object)
+            report.add('standard fields', 'unique names', report.file(object), seconds, validation_errors)
+            errors = errors + validation_errors
+
+    report.add_phase('standard fields', time.perf_counter() - start)
+
+    # expansions are memoized, the cycle check and the search cost share them
+    expander = MacroExpander(objects['macros'], objects['detections'])
+
+    # a macro expanding into itself breaks every search using it
+    if changed is None or selected['macros']:
+        start = time.perf_counter()
+        cycle_errors = [error('macro-cycle', "ERROR: " + cycle) for cycle in expander.cycles()]
+        report.add('search checks', 'macro cycles', None, time.perf_counter() - start, cycle_errors)
+        report.add_phase('search checks', time.perf_counter() - start)
+        errors = errors + cycle_errors
+
+    errors = errors + run_checks(report, 'search checks', 'detection search', partial(validate_detection_search, macros=index['macros']), selected['detections'], executor)
+    errors = errors + run_checks(report, 'search checks', 'baseline search', partial(validate_baseline_search, macros=index['macros']), selected['baselines'], executor)
+    errors = errors + run_checks(report, 'search checks', 'lookup references', partial(validate_lookup_references, index=index), selected['detections'] + selected['baselines'], executor)
+
+    start = time.perf_counter()
+    check_cost = partial(validate_search_cost, expander=expander, max_cost=MAX_SEARCH_COST)
+    for object, ((findings, validation_errors), seconds) in zip(selected['detections'], map_checks(executor, partial(timed, check_cost), selected['detections'])):
+        report.add('search cost', 'search cost', report.file(object), seconds, validation_errors, findings)
+        errors = errors + validation_errors
+        if verbose and findings:
+            cost, indexer, search_head = search_cost(findings)
+            print("search cost {0} (indexer {1}, search head {2}) of detection: {3}".format(cost, indexer, search_head, object['name']))
+            for finding in findings:
+                print("\t{0}: {1}".format(finding['rule'], finding['message']))
+    report.add_phase('search cost', time.perf_counter() - start)
 
     errors = lookup_errors + errors
 
@@ -89,12 +358,12 @@ def validate_standard_fields(object, uuids):
     errors = []
 
     if object['id'] == '':
-        errors.append('ERROR: Blank ID for object: %s' % object['name'])
+        errors.append(error('blank-id', 'ERROR: Blank ID for object: %s' % object['name']))
 
     if object['id'] in uuids:
-        errors.append('ERROR: Duplicate UUID found for object: %s' % object['name'])
+        errors.append(error('duplicate-id', 'ERROR: Duplicate UUID found for object: %s' % object['name']))
     else:
-        uuids.append(object['id'])
+        uuids.add(object['id'])
 
     # if object['name'].endswith(" "):
     #     errors.append(
@@ -103,89 +372,254 @@ def validate_standard_fields(object, uuids):
 
     invalidChars = set(string.punctuation.replace("-", ""))
     if any(char in invalidChars for char in object['name']):
-        errors.append('ERROR: No special characters allowed in name for object: %s' % object['name'])
+        errors.append(error('name-characters', 'ERROR: No special characters allowed in name for object: %s' % object['name']))
 
     try:
         object['description'].encode('ascii')
     except UnicodeEncodeError:
-        errors.append("ERROR: description not ascii for object: %s" % object['name'])
+        errors.append(error('description-ascii', "ERROR: description not ascii for object: %s" % object['name']))
 
     if 'how_to_implement' in object:
         try:
             object['how_to_implement'].encode('ascii')
         except UnicodeEncodeError:
-            errors.append('ERROR: how_to_implement not ascii for object: %s' % object['name'])
+            errors.append(error('how-to-implement-ascii', 'ERROR: how_to_implement not ascii for object: %s' % object['name']))
 
     try:
         datetime.datetime.strptime(object['date'], '%Y-%m-%d')
     except ValueError:
-        errors.append("ERROR: Incorrect date format, should be YYYY-MM-DD for object: %s" % object['name'])
+        errors.append(error('date-format', "ERROR: Incorrect date format, should be YYYY-MM-DD for object: %s" % object['name']))
 
     return errors, uuids
 
 
-def validate_detection_search(object, macros):
+def validate_unique_name(type, object, names):
     errors = []
 
-    if not '_filter' in object['search']:
-        errors.append("ERROR: Missing filter for detection: " + object['name'])
+    if object['name'] in names:
+        errors.append(error('duplicate-name', 'ERROR: Duplicate name found for %s: %s' % (type, object['name'])))
+    else:
+        names.add(object['name'])
+
+    return errors
+
+
+def macro_references(search, macros):
+    '''Errors for the macros of a search without a definition, generated and CIM macros excluded.'''
+    errors = []
+
+    for macro in search.macro_names():
+        if '_filter' in macro or 'security_content_ctime' in macro or 'drop_dm_object_name' in macro or 'cim_' in macro or 'get_' in macro:
+            continue
+        if macro not in macros:
+            errors.append(macro)
+
+    return errors
+
+
+def search_syntax(object, search):
+    errors = []
+    for text in search.unterminated():
+        if text.startswith('`'):
+            errors.append(error('search-syntax', "ERROR: unbalanced backticks in search of: " + object['name']))
+        else:
+            errors.append(error('search-syntax', "ERROR: unterminated string " + text.split()[0] + " in search of: " + object['name']))
+    return errors
+
+
+def uses_source_fields(search):
+    terms = [(field, value) for command, field, operator, value in search.terms() if field in SOURCE_FIELDS]
+    return len(terms) > 0 and ('index', '_internal') not in terms
 
-    filter_macro = re.search("([a-z0-9_]*_filter)", object['search'])
-    if filter_macro.group(1) != (object['name'].replace(' ', '_').replace('-', '_').replace('.', '_').replace('/', '_').lower() + '_filter'):
-        errors.append("ERROR: filter for detection: " + object['name'] + " needs to use the name of the detection in lowercase and the special characters needs to be converted into _ .")
 
-    if any(x in object['search'] for x in ['eventtype=', 'sourcetype=', ' source=', 'index=']):
-        if not 'index=_internal' in object['search']:
-            errors.append("ERROR: Use source macro instead of eventtype, sourcetype, source or index in detection: " + object['name'])
+def validate_detection_search(object, macros):
+    errors = []
+    search = parse_search(object['search'])
+    # macros and filters can't be told apart in a search with broken quoting
+    errors = errors + search_syntax(object, search)
+    if errors:
+        return errors
 
-    macros_found = re.findall('\`([^\s]+)`',object['search'])
-    macros_filtered = []
-    for macro in macros_found:
-        if not '_filter' in macro and not 'security_content_ctime' in macro and not 'drop_dm_object_name' in macro and not 'cim_' in macro and not 'get_' in macro:
-            macros_filtered.append(macro)
+    filter_macros = [macro for macro in search.macro_names() if macro.endswith('_filter')]
+    if not filter_macros:
+        errors.append(error('missing-filter', "ERROR: Missing filter for detection: " + object['name']))
+    elif filter_macro_name(object['name']) not in filter_macros:
+        errors.append(error('filter-name', "ERROR: filter for detection: " + object['name'] + " needs to use the name of the detection in lowercase and the special characters needs to be converted into _ ."))
 
-    for macro in macros_filtered:
-        found_macro = False
-        for macro_obj in macros:
-            if macro_obj['name'] == macro:
-                found_macro = True
+    if uses_source_fields(search):
+        errors.append(error('source-fields', "ERROR: Use source macro instead of eventtype, sourcetype, source or index in detection: " + object['name']))
 
-        if not found_macro:
-            errors.append("ERROR: macro definition for " + macro + " can't be found for detection " + object['name'])
+    for macro in macro_references(search, macros):
+        errors.append(error('unknown-macro', "ERROR: macro definition for " + macro + " can't be found for detection " + object['name']))
 
     return errors
 
 def validate_baseline_search(object, macros):
     errors = []
+    search = parse_search(object['search'])
+    # macros and filters can't be told apart in a search with broken quoting
+    errors = errors + search_syntax(object, search)
+    if errors:
+        return errors
 
-    if any(x in object['search'] for x in ['eventtype=', 'sourcetype=', ' source=', 'index=']):
-        if not 'index=_internal' in object['search']:
-            errors.append("ERROR: Use source macro instead of eventtype, sourcetype, source or index in detection: " + object['name'])
+    if uses_source_fields(search):
+        errors.append(error('source-fields', "ERROR: Use source macro instead of eventtype, sourcetype, source or index in detection: " + object['name']))
 
-    macros_found = re.findall('\`([^\s]+)`',object['search'])
-    macros_filtered = []
-    for macro in macros_found:
-        if not '_filter' in macro and not 'security_content_ctime' in macro and not 'drop_dm_object_name' in macro and not 'cim_' in macro and not 'get_' in macro:
-            macros_filtered.append(macro)
+    for macro in macro_references(search, macros):
+        errors.append(error('unknown-macro', "ERROR: macro definition for " + macro + " can't be found for detection " + object['name']))
+
+    return errors
+
+
+def validate_search_cost(object, expander, max_cost=None):
+    '''Cost findings of a detection search, and an error when its total cost is above max_cost.'''
+    errors = []
+    findings = lint_search(object['search'], expander)
+    cost, indexer, search_head = search_cost(findings)
 
-    for macro in macros_filtered:
-        found_macro = False
-        for macro_obj in macros:
-            if macro_obj['name'] == macro:
-                found_macro = True
+    if max_cost is not None and cost > max_cost:
+        rules = ", ".join(sorted(set(finding['rule'] for finding in findings)))
+        errors.append(error('search-cost', "ERROR: search cost {0} of detection {1} is above {2}: {3}".format(cost, object['name'], max_cost, rules)))
 
-        if not found_macro:
-            errors.append("ERROR: macro definition for " + macro + " can't be found for detection " + object['name'])
+    return findings, errors
+
+
+def validate_lookup_references(object, index):
+    errors = []
+
+    for command, name in parse_search(object['search']).lookups():
+        if command == 'outputlookup' or name in EXTERNAL_LOOKUPS or name.startswith('cim_'):
+            continue
+        # a lookup is referenced by its name or by its csv file, or created by another search
+        if name in index['lookups'] or name in index['lookup_files'] or name in index['output_lookups']:
+            continue
+        errors.append(error('unknown-lookup', "ERROR: lookup definition for " + name + " can't be found for " + object['name']))
 
     return errors
 
 
-def validate_lookups_content(REPO_PATH, lookup_path, lookup):
+def parse_match_type(match_type):
+    '''{field: match type} of a match_type setting, None when it doesn't parse.'''
+    match_types = {}
+    for entry in match_type.split(','):
+        match = MATCH_TYPE.match(entry.strip())
+        if match is None:
+            return None
+        match_types[match.group(2)] = match.group(1)
+    return match_types
+
+
+def validate_lookups_content(REPO_PATH, lookup_path, lookup, max_size=LOOKUP_MAX_SIZE, max_rows=LOOKUP_MAX_ROWS):
     errors = []
-    if 'filename' in lookup:
-        lookup_csv_file = path.join(path.expanduser(REPO_PATH), lookup_path % lookup['filename'])
-        if not path.isfile(lookup_csv_file):
-            errors.append("ERROR: filename {} does not exist".format(lookup['filename']))
+    if not 'filename' in lookup:
+        return errors
+
+    filename = lookup['filename']
+    lookup_csv_file = path.join(path.expanduser(REPO_PATH), lookup_path % filename)
+    if not path.isfile(lookup_csv_file):
+        errors.append(error('lookup-missing', "ERROR: filename {} does not exist".format(filename)))
+        return errors
+
+    size = path.getsize(lookup_csv_file)
+    if size > max_size:
+        errors.append(error('lookup-size', "ERROR: lookup {0} is {1} bytes, more than the {2} bytes allowed".format(filename, size, max_size)))
+
+    match_types = {}
+    if 'match_type' in lookup:
+        match_types = parse_match_type(lookup['match_type'])
+        if match_types is None:
+            errors.append(error('lookup-match-type', "ERROR: match_type of lookup {0} needs to be a comma separated list of WILDCARD(field), CIDR(field) or EXACT(field)".format(lookup['name'])))
+            match_types = {}
+
+    # an empty file is filled by an outputlookup at search time
+    if size == 0:
+        return errors
+
+    try:
+        errors = errors + validate_lookup_rows(lookup, lookup_csv_file, match_types, max_rows)
+    except (csv.Error, UnicodeDecodeError) as exc:
+        errors.append(error('lookup-csv', "ERROR: lookup {0} is not a valid csv file: {1}".format(filename, exc)))
+
+    return errors
+
+
+def validate_lookup_rows(lookup, lookup_csv_file, match_types, max_rows):
+    '''
+    Streams the csv once: memory stays flat no matter the size of the file, only a hash per row is
+    kept for the duplicate checks, and only up to max_rows rows.
+    '''
+    errors = []
+    filename = lookup['filename']
+
+    with open(lookup_csv_file, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return [error('lookup-header', "ERROR: lookup {0} has no header".format(filename))]
+
+        columns = [column.strip() for column in header]
+        if '' in columns or len(set(columns)) != len(columns):
+            errors.append(error('lookup-header', "ERROR: lookup {0} has empty or duplicate column names in its header".format(filename)))
+        for field in sorted(match_types):
+            if field not in columns:
+                errors.append(error('lookup-match-type', "ERROR: match_type field {0} of lookup {1} is not a column of {2}".format(field, lookup['name'], filename)))
+
+        # rows are only unique per key when a lookup returns a single match
+        key_columns = [columns.index(field) for field in sorted(match_types) if field in columns] or [0]
+        check_keys = lookup.get('max_matches') == 1
+        wildcard_columns = [i for i, column in enumerate(columns) if match_types.get(column) == 'WILDCARD']
+
+        rows = 0
+        seen_rows = set()
+        seen_keys = set()
+        # problem: [count, first line]
+        problems = {}
+
+        def problem(name):
+            if name not in problems:
+                problems[name] = [0, reader.line_num]
+            problems[name][0] += 1
+
+        for row in reader:
+            if not row:
+                continue
+            rows += 1
+            if len(row) != len(header):
+                problem('columns')
+                continue
+
+            if rows <= max_rows:
+                digest = hash(tuple(row))
+                if digest in seen_rows:
+                    problem('duplicate rows')
+                seen_rows.add(digest)
+
+                if check_keys:
+                    digest = hash(tuple(row[i] for i in key_columns))
+                    if digest in seen_keys:
+                        problem('duplicate keys')
+                    seen_keys.add(digest)
+
+            for i in wildcard_columns:
+                if '**' in row[i] or row[i].strip() == '':
+                    problem('wildcards')
+            if key_columns[0] not in wildcard_columns and '*' in row[key_columns[0]]:
+                problem('literal wildcards')
+
+    messages = {
+        'columns': "rows without the {0} columns of the header".format(len(header)),
+        'duplicate rows': "duplicate rows",
+        'duplicate keys': "duplicate keys in a lookup with max_matches = 1",
+        'wildcards': "empty or ** wildcard patterns in WILDCARD() fields",
+        'literal wildcards': "* values in {0}, which has no WILDCARD({0}) match_type and matches them literally".format(columns[key_columns[0]]),
+    }
+    for name in ['columns', 'duplicate rows', 'duplicate keys', 'wildcards', 'literal wildcards']:
+        if name in problems:
+            count, line = problems[name]
+            errors.append(error('lookup-' + name.replace(' ', '-'), "ERROR: lookup {0} has {1} {2}, first at line {3}".format(filename, count, messages[name], line)))
+
+    if rows > max_rows:
+        errors.append(error('lookup-rows', "ERROR: lookup {0} has {1} rows, more than the {2} rows allowed".format(filename, rows, max_rows)))
 
     return errors
 
@@ -197,29 +631,64 @@ if __name__ == "__main__":
         VALIDATE DOES NOT PROCESS RESPONSES SPEC for the moment.""")
     parser.add_argument("-p", "--path", required=True, help="path to security-security content repo")
     parser.add_argument("-v", "--verbose", required=False, action='store_true', help="prints verbose output")
+    parser.add_argument("--cache_file", required=False, default=None, help="path to the parsed manifest cache, defaults to <path>/.cache/manifests.pickle")
+    parser.add_argument("--no_cache", required=False, default=False, action='store_true', help="parse every manifest from scratch and do not touch the cache")
+    parser.add_argument("--changed_since", "--changed-since", required=False, default=None, metavar="REV", help="only validate the manifests changed since the git revision REV and the references to them, renamed manifests count as deleted under their old name")
+    parser.add_argument("--max_lookup_size", required=False, type=int, default=LOOKUP_MAX_SIZE // (1024 * 1024), help="largest lookup csv file allowed in MB, defaults to 10")
+    parser.add_argument("--max_lookup_rows", required=False, type=int, default=LOOKUP_MAX_ROWS, help="most rows allowed in a lookup csv file, defaults to 500000")
+    parser.add_argument("-j", "--jobs", required=False, type=int, default=1, help="number of processes validating manifests in parallel, defaults to 1")
+    parser.add_argument("--max_search_cost", required=False, type=int, default=None, help="fail detections whose estimated search cost is above this, costs are only reported with -v by default")
+    parser.add_argument("--json_report", required=False, default=None, help="write every check with its file, wall time and errors to this JSON file")
+    parser.add_argument("--junit_report", required=False, default=None, help="write the checks as JUnit XML test cases to this file")
     # parse them
     args = parser.parse_args()
     REPO_PATH = args.path
     verbose = args.verbose
+    JOBS = max(1, args.jobs)
+    LOOKUP_MAX_SIZE = args.max_lookup_size * 1024 * 1024
+    LOOKUP_MAX_ROWS = args.max_lookup_rows
+    MAX_SEARCH_COST = args.max_search_cost
+    cache = None if args.no_cache else ManifestCache(args.cache_file or default_cache_file(REPO_PATH))
+    changed = changed_manifests(REPO_PATH, args.changed_since) if args.changed_since else None
 
     validation_objects = ['macros','lookups','stories','detections','baselines','response_tasks','responses','deployments']
 
     objects = {}
     schema_error = False
     schema_errors = []
+    report = Report()
 
-    for validation_object in validation_objects:
-        objects, error, errors = validate_schema(REPO_PATH, validation_object, objects)
-        schema_error = schema_error or error
-        if len(errors) > 0:
-            schema_errors = schema_errors + errors
-
-    validation_errors = validate_objects(REPO_PATH, objects)
+    executor = ProcessPoolExecutor(max_workers=JOBS) if JOBS > 1 else None
+    try:
+        for validation_object in validation_objects:
+            objects, type_error, errors = validate_schema(REPO_PATH, validation_object, objects, cache, executor, changed, report)
+            schema_error = schema_error or type_error
+            if len(errors) > 0:
+                schema_errors = schema_errors + errors
+
+        if cache is not None:
+            cache.save()
+
+        validation_errors = validate_objects(REPO_PATH, objects, executor, changed, report)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if verbose and changed is not None:
+        print("validated {0} manifests changed since {1}".format(len(changed), args.changed_since))
+
+    if args.json_report:
+        report.write_json(args.json_report)
+    if args.junit_report:
+        report.write_junit(args.junit_report)
+    if verbose:
+        for line in report.summary():
+            print(line)
 
     schema_errors = schema_errors + validation_errors
 
     for schema_error in schema_errors:
-        print(schema_error)
+        print(schema_error['message'])
 
     if schema_error or len(schema_errors) > 0:
         sys.exit("Errors found")
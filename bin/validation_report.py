@@ -0,0 +1,88 @@
+'''
+Machine readable results of validate.py: every check that ran, the file it ran on, how long it took
+and the errors it found, plus the wall time of each validation phase. Written as JSON or JUnit XML.
+'''
+
+import json
+import time
+from xml.etree import ElementTree
+
+
+def error(rule, message):
+    '''A validation error: the id of the rule it breaks and the message printed for it.'''
+    return {'rule': rule, 'message': message}
+
+
+def timed(check, item):
+    '''Runs check(item), returns its result and how long it took. Runs in the pool workers too.'''
+    start = time.perf_counter()
+    result = check(item)
+    return result, time.perf_counter() - start
+
+
+class Report(object):
+
+    def __init__(self):
+        self.phases = {}
+        self.checks = []
+        self.files = {}
+
+    def add_file(self, object, manifest_file):
+        self.files[id(object)] = manifest_file
+
+    def file(self, object):
+        return self.files.get(id(object))
+
+    def add(self, phase, check, file, seconds, errors, findings=None):
+        '''Records a check run, findings being what it measured without failing the validation.'''
+        self.checks.append({'phase': phase, 'check': check, 'file': file, 'time': seconds, 'errors': errors, 'findings': findings})
+
+    def add_phase(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def errors(self):
+        return [dict(error, file=check['file'], check=check['check'], time=check['time'])
+                for check in self.checks for error in check['errors']]
+
+    def summary(self):
+        '''One line per phase with its wall time and number of checks and errors.'''
+        lines = []
+        for phase, seconds in self.phases.items():
+            checks = [check for check in self.checks if check['phase'] == phase]
+            errors = sum(len(check['errors']) for check in checks)
+            lines.append("{0:<16} {1:8.3f}s {2:6d} checks {3:4d} errors".format(phase, seconds, len(checks), errors))
+        return lines
+
+    def write_json(self, output_file):
+        report = {
+            'phases': [{'phase': phase, 'time': seconds} for phase, seconds in self.phases.items()],
+            'checks': [dict((key, check[key]) for key in ['phase', 'check', 'file', 'time', 'findings'] if check[key] is not None)
+                       for check in self.checks],
+            'errors': self.errors(),
+        }
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def write_junit(self, output_file):
+        # a test suite per phase, a test case per check run
+        testsuites = ElementTree.Element('testsuites', name='security-content validation')
+        total_tests = total_failures = 0
+        for phase, seconds in self.phases.items():
+            checks = [check for check in self.checks if check['phase'] == phase]
+            failures = len([check for check in checks if check['errors']])
+            total_tests += len(checks)
+            total_failures += failures
+
+            testsuite = ElementTree.SubElement(testsuites, 'testsuite', name=phase, tests=str(len(checks)),
+                                               failures=str(failures), errors='0', time='{0:.6f}'.format(seconds))
+            for check in checks:
+                testcase = ElementTree.SubElement(testsuite, 'testcase', classname=check['check'],
+                                                  name=check['file'] or check['check'], time='{0:.6f}'.format(check['time']))
+                for check_error in check['errors']:
+                    failure = ElementTree.SubElement(testcase, 'failure', type=check_error['rule'], message=check_error['message'])
+                    failure.text = check_error['message']
+
+        testsuites.set('tests', str(total_tests))
+        testsuites.set('failures', str(total_failures))
+        testsuites.set('time', '{0:.6f}'.format(sum(self.phases.values())))
+        ElementTree.ElementTree(testsuites).write(output_file, encoding='utf-8', xml_declaration=True)
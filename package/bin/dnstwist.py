@@ -31,16 +31,77 @@ import re
 import csv
 import time
 import os
+import json
+import shutil
+import hashlib
+import itertools
+import multiprocessing
+from functools import partial
 
 from splunklib.searchcommands import dispatch, GeneratingCommand, \
-    Configuration, Option, Boolean
+    Configuration, Option, Boolean, Integer
 from splunk.clilib.bundle_paths import make_splunkhome_path
 
 
+GLYPHS = {
+    'a': [u'à', u'á', u'â', u'ã', u'ä', u'å', u'ɑ', u'а', u'ạ', u'ǎ', u'ă', u'ȧ', u'ӓ'],
+    'b': ['d', 'lb', 'ib', u'ʙ', u'Ь', u'b̔', u'ɓ', u'Б'],
+    'c': [u'ϲ', u'с', u'ƈ', u'ċ', u'ć', u'ç'],
+    'd': ['b', 'cl', 'dl', 'di', u'ԁ', u'ժ', u'ɗ', u'đ'],
+    'e': [u'é', u'ê', u'ë', u'ē', u'ĕ', u'ě', u'ė', u'е', u'ẹ', u'ę', u'є', u'ϵ', u'ҽ'],
+    'f': [u'Ϝ', u'ƒ', u'Ғ'],
+    'g': ['q', u'ɢ', u'ɡ', u'Ԍ', u'ġ', u'ğ', u'ց', u'ǵ', u'ģ'],
+    'h': ['lh', 'ih', u'һ', u'հ', u'Ꮒ', u'н'],
+    'i': ['1', 'l', u'Ꭵ', u'í', u'ï', u'ı', u'ɩ', u'ι', u'ꙇ', u'ǐ', u'ĭ'],
+    'j': [u'ј', u'ʝ', u'ϳ', u'ɉ'],
+    'k': ['lk', 'ik', 'lc', u'κ', u'ⲕ'],
+    'l': ['1', 'i', u'ɫ', u'ł'],
+    'm': ['n', 'nn', 'rn', 'rr', u'ṃ', u'ᴍ', u'м', u'ɱ'],
+    'n': ['m', 'r', u'ń'],
+    'o': ['0', u'Ο', u'ο', u'О', u'о', u'Օ', u'ȯ', u'ọ', u'ỏ', u'ơ', u'ó', u'ö', u'ӧ'],
+    'p': [u'ρ', u'р', u'ƿ', u'Ϸ', u'Þ'],
+    'q': ['g', u'զ', u'ԛ', u'գ', u'ʠ'],
+    'r': [u'ʀ', u'Г', u'ᴦ', u'ɼ', u'ɽ'],
+    's': [u'Ⴝ', u'Ꮪ', u'ʂ', u'ś', u'ѕ'],
+    't': [u'τ', u'т', u'ţ'],
+    'u': [u'μ', u'υ', u'Ս', u'ս', u'ц', u'ᴜ', u'ǔ', u'ŭ'],
+    'v': [u'ѵ', u'ν', u'v̇'],
+    'w': ['vv', u'ѡ', u'ա', u'ԝ'],
+    'x': [u'х', u'ҳ', u'ẋ'],
+    'y': [u'ʏ', u'γ', u'у', u'Ү', u'ý'],
+    'z': [u'ʐ', u'ż', u'ź', u'ᴢ']
+}
+
+
+HOSTNAME = re.compile('(?=^.{4,253}$)(^((?!-)[a-zA-Z0-9-]{1,63}(?<!-)\\.)+[a-zA-Z]{2,63}\\.?$)', re.IGNORECASE)
+IDNA_HOSTNAME = re.compile(HOSTNAME.pattern.encode('ascii'), re.IGNORECASE)
+
+IDNA_CACHE = {}
+IDNA_CACHE_SIZE = 65536
+
+# bump whenever a fuzzer changes its output, cached permutations of other versions are thrown away
+FUZZER_VERSION = 1
+CACHE_DIRECTORY = 'dnstwist_cache'
+
+
+def idna_encode(domain):
+    # candidates come back from several fuzzers and domains, their encodings are kept up to IDNA_CACHE_SIZE
+    try:
+        return IDNA_CACHE[domain]
+    except KeyError:
+        pass
+
+    if len(IDNA_CACHE) >= IDNA_CACHE_SIZE:
+        IDNA_CACHE.clear()
+    encoded = IDNA_CACHE[domain] = domain.encode('idna')
+    return encoded
+
+
 class DomainFuzz(object):
 
-    def __init__(self, domain):
+    def __init__(self, domain, homoglyph_depth=1):
         self.domain, self.tld = self.__domain_tld(domain)
+        self.homoglyph_depth = homoglyph_depth
         self.domains = []
         self.qwerty = {
             '1': '2q', '2': '3wq1', '3': '4ew2', '4': '5re3',
@@ -88,29 +149,19 @@ class DomainFuzz(object):
         return domain[0] + '.' + domain[1], domain[2]
 
     def __validate_domain(self, domain):
-        if len(domain) == len(domain.encode('idna')) and domain != domain.encode('idna'):
-            return False
-        allowed = re.compile(b'(?=^.{4,253}$)(^((?!-)[a-zA-Z0-9-]{1,63}(?<!-)\\.)+[a-zA-Z]{2,63}\\.?$)', re.IGNORECASE)
-        return allowed.match(domain.encode('idna'))
-
-    def __filter_domains(self):
-        seen = set()
-        filtered = []
-
-        for d in self.domains:
-            # if not self.__validate_domain(d['domain-name']):
-            #   p_err("debug: invalid domain %s\n" % d['domain-name'])
-            try:
-                if self.__validate_domain(d['domain-name']) and d['domain-name'] not in seen:
-                    seen.add(d['domain-name'])
-                    filtered.append(d)
-            except ValueError:
-                continue
-
-        self.domains = filtered
+        try:
+            domain.encode('ascii')
+        except UnicodeError:
+            # an internationalized name only passes in its punycode form
+            encoded = idna_encode(domain)
+            if len(domain) == len(encoded):
+                return False
+            return IDNA_HOSTNAME.match(encoded)
+
+        # the idna encoding of an ascii name is the name itself
+        return HOSTNAME.match(domain)
 
     def __bitsquatting(self):
-        result = []
         masks = [1, 2, 4, 8, 16, 32, 64, 128]
         for i in range(0, len(self.domain)):
             c = self.domain[i]
@@ -118,188 +169,221 @@ class DomainFuzz(object):
                 b = chr(ord(c) ^ masks[j])
                 o = ord(b)
                 if (o >= 48 and o <= 57) or (o >= 97 and o <= 122) or o == 45:
-                    result.append(self.domain[:i] + b + self.domain[i+1:])
+                    yield self.domain[:i] + b + self.domain[i+1:]
 
-        return result
+    def __substitute(self, positions, glyphs):
+        domain = list(self.domain)
+        for position, glyph in zip(positions, glyphs):
+            domain[position] = glyph
+        return ''.join(domain)
 
     def __homoglyph(self):
-        glyphs = {
-            'a': [u'à', u'á', u'â', u'ã', u'ä', u'å', u'ɑ', u'а', u'ạ', u'ǎ', u'ă', u'ȧ', u'ӓ'],
-            'b': ['d', 'lb', 'ib', u'ʙ', u'Ь', u'b̔', u'ɓ', u'Б'],
-            'c': [u'ϲ', u'с', u'ƈ', u'ċ', u'ć', u'ç'],
-            'd': ['b', 'cl', 'dl', 'di', u'ԁ', u'ժ', u'ɗ', u'đ'],
-            'e': [u'é', u'ê', u'ë', u'ē', u'ĕ', u'ě', u'ė', u'е', u'ẹ', u'ę', u'є', u'ϵ', u'ҽ'],
-            'f': [u'Ϝ', u'ƒ', u'Ғ'],
-            'g': ['q', u'ɢ', u'ɡ', u'Ԍ', u'Ԍ', u'ġ', u'ğ', u'ց', u'ǵ', u'ģ'],
-            'h': ['lh', 'ih', u'һ', u'հ', u'Ꮒ', u'н'],
-            'i': ['1', 'l', u'Ꭵ', u'í', u'ï', u'ı', u'ɩ', u'ι', u'ꙇ', u'ǐ', u'ĭ'],
-            'j': [u'ј', u'ʝ', u'ϳ', u'ɉ'],
-            'k': ['lk', 'ik', 'lc', u'κ', u'ⲕ', u'κ'],
-            'l': ['1', 'i', u'ɫ', u'ł'],
-            'm': ['n', 'nn', 'rn', 'rr', u'ṃ', u'ᴍ', u'м', u'ɱ'],
-            'n': ['m', 'r', u'ń'],
-            'o': ['0', u'Ο', u'ο', u'О', u'о', u'Օ', u'ȯ', u'ọ', u'ỏ', u'ơ', u'ó', u'ö', u'ӧ'],
-            'p': [u'ρ', u'р', u'ƿ', u'Ϸ', u'Þ'],
-            'q': ['g', u'զ', u'ԛ', u'գ', u'ʠ'],
-            'r': [u'ʀ', u'Г', u'ᴦ', u'ɼ', u'ɽ'],
-            's': [u'Ⴝ', u'Ꮪ', u'ʂ', u'ś', u'ѕ'],
-            't': [u'τ', u'т', u'ţ'],
-            'u': [u'μ', u'υ', u'Ս', u'ս', u'ц', u'ᴜ', u'ǔ', u'ŭ'],
-            'v': [u'ѵ', u'ν', u'v̇'],
-            'w': ['vv', u'ѡ', u'ա', u'ԝ'],
-            'x': [u'х', u'ҳ', u'ẋ'],
-            'y': [u'ʏ', u'γ', u'у', u'Ү', u'ý'],
-            'z': [u'ʐ', u'ż', u'ź', u'ʐ', u'ᴢ']
-        }
-
-        result = []
-
-        for ws in range(0, len(self.domain)):
-            for i in range(0, (len(self.domain)-ws)+1):
-                win = self.domain[i:i+ws]
-
-                j = 0
-                while j < ws:
-                    c = win[j]
-                    if c in glyphs:
-                        win_copy = win
-                        for g in glyphs[c]:
-                            win = win.replace(c, g)
-                            result.append(self.domain[:i] + win + self.domain[i+ws:])
-                            win = win_copy
-                    j += 1
-
-        return list(set(result))
+        # every run of consecutive occurrences of a character is swapped for each of its glyphs, google gives
+        # g0ogle, go0gle and g00gle, as long as the run leaves the first or the last character of the domain alone
+        occurrences = {}
+        for i, c in enumerate(self.domain):
+            if c in GLYPHS:
+                occurrences.setdefault(c, []).append(i)
+
+        last = len(self.domain) - 1
+        for c in sorted(occurrences):
+            positions = occurrences[c]
+            for start in range(0, len(positions)):
+                for end in range(start + 1, len(positions) + 1):
+                    if positions[start] == 0 and positions[end - 1] == last:
+                        continue
+                    run = positions[start:end]
+                    for g in GLYPHS[c]:
+                        yield self.__substitute(run, [g] * len(run))
+
+        # up to homoglyph_depth characters swapped for glyphs of their own, skipping the runs swapped alike above
+        candidates = [i for i, c in enumerate(self.domain) if c in GLYPHS]
+        for depth in range(2, self.homoglyph_depth + 1):
+            for positions in itertools.combinations(candidates, depth):
+                chars = set(self.domain[i] for i in positions)
+                run = len(chars) == 1 and positions == tuple(i for i in occurrences[self.domain[positions[0]]]
+                                                              if positions[0] <= i <= positions[-1])
+                run = run and not (positions[0] == 0 and positions[-1] == last)
+                for glyphs in itertools.product(*[GLYPHS[self.domain[i]] for i in positions]):
+                    if run and len(set(glyphs)) == 1:
+                        continue
+                    yield self.__substitute(positions, glyphs)
 
     def __hyphenation(self):
-        result = []
-
         for i in range(1, len(self.domain)):
-            result.append(self.domain[:i] + '-' + self.domain[i:])
-
-        return result
+            yield self.domain[:i] + '-' + self.domain[i:]
 
     def __insertion(self):
-        result = []
-
         for i in range(1, len(self.domain)-1):
             for keys in self.keyboards:
                 if self.domain[i] in keys:
                     for c in keys[self.domain[i]]:
-                        result.append(self.domain[:i] + c + self.domain[i] + self.domain[i+1:])
-                        result.append(self.domain[:i] + self.domain[i] + c + self.domain[i+1:])
-
-        return list(set(result))
+                        yield self.domain[:i] + c + self.domain[i] + self.domain[i+1:]
+                        yield self.domain[:i] + self.domain[i] + c + self.domain[i+1:]
 
     def __omission(self):
-        result = []
-
         for i in range(0, len(self.domain)):
-            result.append(self.domain[:i] + self.domain[i+1:])
+            yield self.domain[:i] + self.domain[i+1:]
 
         n = re.sub(r'(.)\1+', r'\1', self.domain)
 
-        if n not in result and n != self.domain:
-            result.append(n)
-
-        return list(set(result))
+        if n != self.domain:
+            yield n
 
     def __repetition(self):
-        result = []
-
         for i in range(0, len(self.domain)):
             if self.domain[i].isalpha():
-                result.append(self.domain[:i] + self.domain[i] + self.domain[i] + self.domain[i+1:])
-
-        return list(set(result))
+                yield self.domain[:i] + self.domain[i] + self.domain[i] + self.domain[i+1:]
 
     def __replacement(self):
-        result = []
-
         for i in range(0, len(self.domain)):
             for keys in self.keyboards:
                 if self.domain[i] in keys:
                     for c in keys[self.domain[i]]:
-                        result.append(self.domain[:i] + c + self.domain[i+1:])
-
-        return list(set(result))
+                        yield self.domain[:i] + c + self.domain[i+1:]
 
     def __subdomain(self):
-        result = []
-
         for i in range(1, len(self.domain)):
             if self.domain[i] not in ['-', '.'] and self.domain[i-1] not in ['-', '.']:
-                result.append(self.domain[:i] + '.' + self.domain[i:])
-
-        return result
+                yield self.domain[:i] + '.' + self.domain[i:]
 
     def __transposition(self):
-        result = []
-
         for i in range(0, len(self.domain)-1):
             if self.domain[i+1] != self.domain[i]:
-                result.append(self.domain[:i] + self.domain[i+1] + self.domain[i] + self.domain[i+2:])
-
-        return result
+                yield self.domain[:i] + self.domain[i+1] + self.domain[i] + self.domain[i+2:]
 
     def __vowel_swap(self):
         vowels = 'aeiou'
-        result = []
 
         for i in range(0, len(self.domain)):
             for vowel in vowels:
                 if self.domain[i] in vowels:
-                    result.append(self.domain[:i] + vowel + self.domain[i+1:])
-
-        return list(set(result))
+                    yield self.domain[:i] + vowel + self.domain[i+1:]
 
     def __addition(self):
-        result = []
-
         for i in range(97, 123):
-            result.append(self.domain + chr(i))
-
-        return result
-
-    def generate(self):
-        self.domains.append({'fuzzer': 'Original*', 'domain-name': self.domain + '.' + self.tld})
-
-        for domain in self.__addition():
-            self.domains.append({'fuzzer': 'Addition', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__bitsquatting():
-            self.domains.append({'fuzzer': 'Bitsquatting', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__homoglyph():
-            self.domains.append({'fuzzer': 'Homoglyph', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__hyphenation():
-            self.domains.append({'fuzzer': 'Hyphenation', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__insertion():
-            self.domains.append({'fuzzer': 'Insertion', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__omission():
-            self.domains.append({'fuzzer': 'Omission', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__repetition():
-            self.domains.append({'fuzzer': 'Repetition', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__replacement():
-            self.domains.append({'fuzzer': 'Replacement', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__subdomain():
-            self.domains.append({'fuzzer': 'Subdomain', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__transposition():
-            self.domains.append({'fuzzer': 'Transposition', 'domain-name': domain + '.' + self.tld})
-        for domain in self.__vowel_swap():
-            self.domains.append({'fuzzer': 'Vowel-swap', 'domain-name': domain + '.' + self.tld})
+            yield self.domain + chr(i)
 
+    def __various(self):
         if not self.domain.startswith('www.'):
-            self.domains.append({'fuzzer': 'Various', 'domain-name': 'ww' + self.domain + '.' + self.tld})
-            self.domains.append({'fuzzer': 'Various', 'domain-name': 'www' + self.domain + '.' + self.tld})
-            self.domains.append({'fuzzer': 'Various', 'domain-name': 'www-' + self.domain + '.' + self.tld})
+            yield 'ww' + self.domain + '.' + self.tld
+            yield 'www' + self.domain + '.' + self.tld
+            yield 'www-' + self.domain + '.' + self.tld
         if '.' in self.tld:
-            self.domains.append({'fuzzer': 'Various', 'domain-name': self.domain + '.' + self.tld.split('.')[-1]})
-            self.domains.append({'fuzzer': 'Various', 'domain-name': self.domain + self.tld})
+            yield self.domain + '.' + self.tld.split('.')[-1]
+            yield self.domain + self.tld
         if '.' not in self.tld:
-            self.domains.append({'fuzzer': 'Various', 'domain-name': self.domain + self.tld + '.' + self.tld})
+            yield self.domain + self.tld + '.' + self.tld
         if self.tld != 'com' and '.' not in self.tld:
-            self.domains.append({'fuzzer': 'Various', 'domain-name': self.domain + '-' + self.tld + '.com'})
+            yield self.domain + '-' + self.tld + '.com'
+
+    def __permutations(self):
+        # fuzzers run one after the other, each one generating its candidates lazily
+        fuzzers = [
+            ('Addition', self.__addition),
+            ('Bitsquatting', self.__bitsquatting),
+            ('Homoglyph', self.__homoglyph),
+            ('Hyphenation', self.__hyphenation),
+            ('Insertion', self.__insertion),
+            ('Omission', self.__omission),
+            ('Repetition', self.__repetition),
+            ('Replacement', self.__replacement),
+            ('Subdomain', self.__subdomain),
+            ('Transposition', self.__transposition),
+            ('Vowel-swap', self.__vowel_swap),
+        ]
+
+        yield 'Original*', self.domain + '.' + self.tld
+        for fuzzer, permutations in fuzzers:
+            for domain in permutations():
+                yield fuzzer, domain + '.' + self.tld
+        for domain in self.__various():
+            yield 'Various', domain
+
+    def fuzz(self):
+        ''' Yields the valid permutations of the domain one at a time, each domain name once, credited to the
+        first fuzzer producing it. Nothing is kept but the names already seen.
+        '''
+        seen = set()
+
+        for fuzzer, domain in self.__permutations():
+            if domain in seen:
+                continue
+            try:
+                if not self.__validate_domain(domain):
+                    continue
+            except ValueError:
+                continue
+            seen.add(domain)
+            yield {'fuzzer': fuzzer, 'domain-name': domain}
 
-        self.__filter_domains()
+    def generate(self):
+        self.domains = list(self.fuzz())
+
+
+class PermutationCache(object):
+    ''' Permutations of each input domain and homoglyph depth, one json file apiece under a directory per
+    FUZZER_VERSION. Every failure to read or write it just means the permutations are computed again.
+    '''
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.version_path = os.path.join(cache_path, 'v%d' % FUZZER_VERSION)
+
+    def __file(self, domain, homoglyph_depth):
+        key = '%d|%s' % (homoglyph_depth, domain)
+        return os.path.join(self.version_path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def contains(self, domain, homoglyph_depth):
+        return os.path.isfile(self.__file(domain, homoglyph_depth))
+
+    def get(self, domain, homoglyph_depth):
+        try:
+            with open(self.__file(domain, homoglyph_depth), 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('domain') != domain or entry.get('homoglyph_depth') != homoglyph_depth:
+            return None
+        return entry['domains']
+
+    def put(self, domain, homoglyph_depth, domains):
+        file_path = self.__file(domain, homoglyph_depth)
+        tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+        try:
+            if not os.path.isdir(self.version_path):
+                self.__prune()
+                os.makedirs(self.version_path)
+            with open(tmp_path, 'w') as f:
+                json.dump({'domain': domain, 'homoglyph_depth': homoglyph_depth, 'domains': domains}, f)
+            os.rename(tmp_path, file_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __prune(self):
+        # permutations of older fuzzers are never read again
+        if os.path.isdir(self.cache_path):
+            for name in os.listdir(self.cache_path):
+                if name.startswith('v') and os.path.join(self.cache_path, name) != self.version_path:
+                    shutil.rmtree(os.path.join(self.cache_path, name), ignore_errors=True)
+
+
+def fuzz_domain(domain, homoglyph_depth=1, cache_path=None):
+    # streams the permutations of a domain, saving them to the cache once all of them went out
+    domains = []
+    for permutation in DomainFuzz(domain, homoglyph_depth).fuzz():
+        domains.append(permutation)
+        yield permutation
+
+    if cache_path is not None:
+        PermutationCache(cache_path).put(domain, homoglyph_depth, domains)
+
+
+def twist_domain(domain, homoglyph_depth=1, cache_path=None):
+    # runs in the worker processes, the permutations of a domain are sent back as a whole
+    return list(fuzz_domain(domain, homoglyph_depth, cache_path))
 
 
 @Configuration(distributed=True)
@@ -321,6 +405,60 @@ class DnsTwistCommand(GeneratingCommand):
         **Description:** Domain to DNS generated twisted entries for.
         ''', name='domain', require=False, default='')
 
+    workers = Option(doc='''
+        **Syntax:** **workers=***<int>*
+        **Description:** Number of processes twisting the domains of a domain list in parallel. The results are
+        still returned in the order of the list. Defaults to 1.
+        ''', name='workers', require=False, default=1, validate=Integer(minimum=1))
+
+    homoglyph_depth = Option(doc='''
+        **Syntax:** **homoglyph_depth=***<int>*
+        **Description:** Also swap up to that many different characters for homoglyphs at once. Every occurrence
+        of a single character is swapped alike in any case. Defaults to 1.
+        ''', name='homoglyph_depth', require=False, default=1, validate=Integer(minimum=1, maximum=3))
+
+    use_cache = Option(doc='''
+        **Syntax:** **use_cache=***<bool>*
+        **Description:** When `true`, the permutations of each domain are read from and saved to a cache in the
+        lookups directory of the app, kept until the fuzzers change. Defaults to `true`.
+        ''', name='use_cache', default=True, validate=Boolean())
+
+    def twisted_domains(self, domains_to_twist):
+        # (domain, permutations) in the order of domains_to_twist. Cached domains are read back, with workers > 1
+        # the others are fuzzed ahead by a pool of processes while the permutations of the current one are written out
+        cache = None
+        cache_path = None
+        if self.use_cache:
+            cache_path = make_splunkhome_path(['etc', 'apps', 'DA-ESS-ContentUpdate', 'lookups', CACHE_DIRECTORY])
+            cache = PermutationCache(cache_path)
+
+        cached = set()
+        if cache is not None:
+            cached = set(domain for domain in domains_to_twist if cache.contains(domain, self.homoglyph_depth))
+        misses = [domain for domain in domains_to_twist if domain not in cached]
+
+        pool = None
+        if self.workers > 1 and len(misses) > 1:
+            pool = multiprocessing.Pool(min(self.workers, len(misses)))
+            chunksize = max(1, len(misses) // (self.workers * 4))
+            twist = partial(twist_domain, homoglyph_depth=self.homoglyph_depth, cache_path=cache_path)
+            results = pool.imap(twist, misses, chunksize)
+
+        try:
+            for domain_to_twist in domains_to_twist:
+                domains = None
+                if domain_to_twist in cached:
+                    domains = cache.get(domain_to_twist, self.homoglyph_depth)
+                elif pool is not None:
+                    domains = next(results)
+                if domains is None:
+                    domains = fuzz_domain(domain_to_twist, self.homoglyph_depth, cache_path)
+                yield domain_to_twist, domains
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
     def generate(self):
         event_count = 0
         csv_file_names = []
@@ -375,11 +513,10 @@ class DnsTwistCommand(GeneratingCommand):
             domains_to_twist = []
             domains_to_twist.append(self.domain)
 
-        for domain_to_twist in domains_to_twist:
-            domain_to_twist = domain_to_twist.lstrip('*')
-            dfuzz = DomainFuzz(domain_to_twist)
-            dfuzz.generate()
-            domains = dfuzz.domains
+        domains_to_twist = [domain_to_twist.lstrip('*') for domain_to_twist in domains_to_twist]
+
+        # permutations are streamed to Splunk as they are generated
+        for domain_to_twist, domains in self.twisted_domains(domains_to_twist):
             for domain in domains:
                 # We don't want to keep the original domain
                 if domain['domain-name'] in domain_to_twist: